@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Compare the JSON decoders in decoders.py on serverStatus documents - decode time and memory allocated per document.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from decoders import get_decoder
+from generators import serverstatus_document
+from serverstatus_metrics import common_metrics, wiredtiger_metrics
+
+__author__ = 'victorhooi'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON decoders on serverStatus documents')
+    parser.add_argument('-c', '--count', default=2000, type=int, help="Number of documents to decode per decoder.")
+    parser.add_argument('-e', '--extra-fields', default=2000, type=int, help="Number of unextracted fields per document.")
+    args = parser.parse_args()
+
+    paths = [['host'], ['version'], ['pid'], ['localTime']] + list(common_metrics.values()) + list(wiredtiger_metrics.values())
+    line = json.dumps(serverstatus_document(extra_fields=args.extra_fields))
+    print("Document size: {} bytes".format(len(line)))
+    print("{:<8} {:>14} {:>16}".format('decoder', 'us/document', 'KB/document'))
+    for name in ('json', 'ujson', 'orjson', 'partial'):
+        try:
+            decode = get_decoder(name, paths=paths)
+        except ValueError:
+            print("{:<8} not installed".format(name))
+            continue
+        start = time.perf_counter()
+        for _ in range(args.count):
+            decode(line)
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        document = decode(line)
+        size, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del document
+        print("{:<8} {:>14.1f} {:>16.1f}".format(name, elapsed / args.count * 1e6, size / 1024))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
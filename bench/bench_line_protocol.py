@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compare building per-point dicts (and letting influxdb-python turn them into line protocol) with encoding line
+protocol directly using line_protocol.LineEncoder.
+
+Each mode runs in its own process so that the peak RSS figures are independent of each other.
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+__author__ = 'victorhooi'
+
+_START = datetime(2015, 8, 16, 22, 28, 15, tzinfo=timezone.utc)
+
+
+def sample_points(count):
+    """Yield (timestamp, fields, tags) tuples shaped like parse_operations output."""
+    for i in range(count):
+        yield (_START + timedelta(milliseconds=i),
+               {'duration_in_milliseconds': i % 5000, 'nscanned': i % 97, 'nreturned': i % 13, 'keyUpdates': 0},
+               {'operation': 'query', 'namespace': 'test.collection{}'.format(i % 10), 'connection_id': 'conn{}'.format(i % 500),
+                'plan_summary': 'IXSCAN'})
+
+
+def run_dict(count, batch_size):
+    from influxdb.line_protocol import make_lines
+    batch = []
+    for timestamp, fields, tags in sample_points(count):
+        tags = dict(tags, project='bench', hostname='db1.example.com')
+        batch.append({"measurement": "operations", "tags": tags, "time": timestamp, "fields": fields})
+        if len(batch) == batch_size:
+            make_lines({'points': batch}, precision='n').encode('utf-8')
+            batch = []
+
+
+def run_line(count, batch_size):
+    from line_protocol import LineEncoder
+    encoder = LineEncoder("operations", {'project': 'bench', 'hostname': 'db1.example.com'})
+    batch = []
+    for timestamp, fields, tags in sample_points(count):
+        batch.append(encoder.encode(timestamp, fields, tags))
+        if len(batch) == batch_size:
+            b'\n'.join(batch)
+            batch = []
+
+
+_MODES = {'dict': run_dict, 'line': run_line}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dict and line protocol encoding paths')
+    parser.add_argument('-c', '--count', default=200000, type=int, help="Number of points to encode.")
+    parser.add_argument('-b', '--batch-size', default=5000, type=int, help="Points per batch.")
+    parser.add_argument('--mode', choices=sorted(_MODES), help="Run a single mode in this process.")
+    args = parser.parse_args()
+
+    if args.mode:
+        start = time.perf_counter()
+        _MODES[args.mode](args.count, args.batch_size)
+        elapsed = time.perf_counter() - start
+        # ru_maxrss is in kilobytes on Linux
+        print("{:<6} {:>12.0f} points/s {:>10.1f} MB peak RSS".format(
+            args.mode, args.count / elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+        return
+    for mode in sorted(_MODES):
+        subprocess.check_call([sys.executable, __file__, '--mode', mode, '--count', str(args.count),
+                               '--batch-size', str(args.batch_size)])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
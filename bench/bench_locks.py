@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Measure what parsing the locks:{...} section of 3.x slow operation lines adds to the cost of each line.
+
+The same generated 3.x lines are parsed (and encoded) with parse_operations.parse_locks() as it is, and replaced by
+one that does nothing - so the difference is the lock scan, plus encoding its fields. The two are timed alternately,
+and the fastest run of each is compared, so that other load on the machine affects both about equally.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytz import utc
+import generators
+import parse_operations
+from line_protocol import LineEncoder
+from timestamps import TimestampParser
+
+__author__ = 'victorhooi'
+
+_logger = logging.getLogger('bench')
+
+
+def skip_locks(locks, values=None):
+    return values
+
+
+def time_it(function, items, lock_parser):
+    parse_operations.parse_locks = lock_parser
+    start = time.process_time()
+    for item in items:
+        function(item)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the locks:{...} scanner in parse_operations')
+    parser.add_argument('-l', '--lines', default=100000, type=int, help="Number of log lines to generate.")
+    parser.add_argument('-r', '--repeat', default=5, type=int, help="Number of runs to take the fastest of.")
+    parser.add_argument('--max-overhead', default=20.0, type=float, help="Exit with an error if the locks add more than this percentage to the cost of parsing and encoding a line. Defaults to 20.")
+    args = parser.parse_args()
+
+    lines = [line for line in generators.operation_lines('3.x', args.lines) if 'locks:{' in line]
+    lock_sections = [line.split("locks:{", 1)[1] for line in lines]
+    timestamps = TimestampParser(tz=utc, year=2015)
+    encoder = LineEncoder("operations", {'project': 'bench', 'hostname': 'db1.example.com'})
+    parse_locks = parse_operations.parse_locks
+    parse = lambda line: parse_operations.parse_operation(line, timestamps, _logger)
+    parse_encode = lambda line: encoder.encode(*parse_operations.parse_operation(line, timestamps, _logger))
+
+    runs = {'parse': (parse, lines, parse_locks), 'parse, without locks': (parse, lines, skip_locks),
+            'parse and encode': (parse_encode, lines, parse_locks),
+            'parse and encode, without locks': (parse_encode, lines, skip_locks),
+            'parse_locks()': (parse_locks, lock_sections, parse_locks)}
+    best = {}
+    for _ in range(args.repeat):
+        for name, (function, items, lock_parser) in runs.items():
+            elapsed = time_it(function, items, lock_parser)
+            best[name] = min(best.get(name, elapsed), elapsed)
+    parse_operations.parse_locks = parse_locks
+
+    print("{} slow operation lines, fastest of {} runs".format(len(lines), args.repeat))
+    for name in runs:
+        print("{:<32} {:>8.2f} us/line".format(name, best[name] / len(lines) * 1e6))
+    parse_overhead = (best['parse'] / best['parse, without locks'] - 1) * 100
+    overhead = (best['parse and encode'] / best['parse and encode, without locks'] - 1) * 100
+    print("Locks add {:.1f}% to parsing, and {:.1f}% to parsing and encoding a line (limit {:.0f}%)".format(
+        parse_overhead, overhead, args.max_overhead))
+    if overhead > args.max_overhead:
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
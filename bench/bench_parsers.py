@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Time each parser end to end, and each of its stages (read, parse, encode, write) on its own, against synthetic input
+from generators.py and the stand-in InfluxDB in influx_sink.py.
+
+End to end runs start the parser script in its own process, writing to the sink on localhost:8086 (the parsers
+always use port 8086, so nothing else can be listening there), and report lines/s, points/s and the process's peak
+RSS. Stage runs are in a process of their own too (so that they don't inflate the peak RSS of later parsers): each
+stage is timed over the output of the one before it, kept in memory.
+"""
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytz import utc
+import generators
+from influx_sink import InfluxSink
+from decoders import get_decoder
+from inputs import read_lines
+from line_protocol import LineEncoder
+from metric_plan import MetricPlan, PlanCache
+from timestamps import TimestampParser
+from writer import PointWriter
+from sinks import InfluxDBSink
+
+__author__ = 'victorhooi'
+
+_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+_TAGS = {'project': 'bench', 'hostname': 'db1.example.com'}
+# Unconfigured, so that the writer's per-batch progress messages aren't printed
+_logger = logging.getLogger('bench')
+
+
+def operations_stages():
+    from parse_operations import parse_operation
+    timestamps = TimestampParser(tz=utc, year=2015)
+    encoder = LineEncoder("operations", _TAGS)
+    parse = lambda lines: [operation for operation in (parse_operation(line, timestamps, _logger) for line in lines) if operation]
+    encode = lambda records: [encoder.encode(*record) for record in records]
+    return parse, encode
+
+
+def connections_stages():
+    # ConnectionHandler parses and encodes in one go, so this follows it with the two stages kept apart
+    from connection_table import ConnectionTable
+    timestamps = TimestampParser(tz=utc, year=2015)
+    connections = ConnectionTable(ttl=86400 * 1000000000)
+    event_encoder = LineEncoder('connection_events', _TAGS)
+    counter_encoder = LineEncoder('connection_counters', _TAGS)
+
+    def parse(lines):
+        records = []
+        for line in lines:
+            timestamp, logline = timestamps.split(line)
+            if ' connections now open)' in line:
+                records.append((counter_encoder, timestamp, {"value": float(line.split("(")[1].split()[0])}, None))
+            if '[initandlisten] connection accepted from' in line:
+                connection_id = logline.split("#")[1].split()[0]
+                connections.open(int(connection_id), timestamp)
+                records.append((event_encoder, timestamp, {"value": 0.0},
+                                {'connection_id': connection_id, 'socket_address': logline.split("accepted from ")[1].split()[0],
+                                 'event_type': 'open_connection'}))
+            elif '] end connection ' in line:
+                connection_id = logline.split("[conn")[1].split("]")[0]
+                start_time = connections.close(int(connection_id), timestamp)
+                records.append((event_encoder, timestamp, {"value": (timestamp - start_time) / 1e9 if start_time else 0.0},
+                                {'connection_id': connection_id, 'socket_address': logline.split("end connection ")[1].split()[0],
+                                 'event_type': 'close_connection', 'matching_connection_open': start_time is not None}))
+        return records
+
+    encode = lambda records: [encoder.encode(timestamp, fields, tags) for encoder, timestamp, fields, tags in records]
+    return parse, encode
+
+
+def iostat_stages():
+    from parse_iostat import block_values, parse_iostat
+    from iostat_columns import ColumnEncoder, numpy, parse_columns
+    encoder = LineEncoder("iostat", _TAGS)
+
+    def blocks(lines):
+        # Skip the header and blank line, as parse_iostat.py does
+        return [block for block, offset in parse_iostat((line, 0) for line in lines[2:])]
+
+    if numpy:
+        # parse_iostat.py's default when NumPy is installed
+        column_encoder = ColumnEncoder(encoder)
+        parse = lambda lines: list(parse_columns(blocks(lines), utc))
+        encode = lambda records: [point for columns in records for point in column_encoder.encode(*columns)]
+        return parse, encode
+    parse = lambda lines: [record for block in blocks(lines) for record in block_values(block, utc)]
+    encode = lambda records: [encoder.encode(*record) for record in records]
+    return parse, encode
+
+
+def serverstatus_stages(discover=False):
+    from counter_rates import CounterRates
+    from parse_serverstatus import curated_metrics, discovered_metrics, encode_point, fingerprint, get_metrics
+    from serverstatus_metrics import counter_metrics
+    decode = get_decoder('auto')
+    rates = CounterRates({})
+
+    def build_plan(document):
+        # Rates of the counters in serverstatus_metrics.py, as parse_serverstatus.py writes
+        for name, definitions in curated_metrics(document).items():
+            rates.counters.setdefault(name, set()).update(counter_metrics(definitions))
+        return MetricPlan((discovered_metrics if discover else curated_metrics)(document))
+
+    plans = PlanCache(fingerprint, build_plan)
+
+    def parse(lines):
+        records = []
+        for line_number, line in enumerate(lines):
+            document = decode(line)
+            metric_data = get_metrics(document, plans.plan_for(document), line_number, 'bench')
+            records.extend(metric_data)
+            timestamp, _, _, tags = metric_data[0]
+            for name, values in rates.update(tags['hostname'], tags['pid'], document.get('uptime'), timestamp,
+                                             {name: values for _, name, values, _ in metric_data}):
+                records.append((timestamp, name + '_rates', values, tags))
+        return records
+
+    encode = lambda records: [point for point in (encode_point(*record) for record in records) if point]
+    return parse, encode
+
+
+# name: (lines generator, parser script, extra arguments, stages - or None to only run it end to end)
+def workloads(args):
+    result = {}
+    for version in generators.LOG_VERSIONS:
+        result['operations-' + version] = (partial(generators.operation_lines, version, args.lines), 'parse_operations.py',
+                                           ['-n', 'db1.example.com'], operations_stages)
+        result['connections-' + version] = (partial(generators.connection_lines, version, args.lines), 'parse_connections.py',
+                                            ['-n', 'db1.example.com'], connections_stages)
+    result['ingest-3.x'] = (partial(generators.mongod_log_lines, '3.x', args.lines), 'ingest_log.py',
+                            ['-n', 'db1.example.com'], None)
+    result['iostat-24h'] = (partial(generators.iostat_lines, args.iostat_blocks, args.iostat_devices), 'parse_iostat.py',
+                            ['-t', 'UTC'], iostat_stages)
+    result['iostat-ampm'] = (partial(generators.iostat_lines, args.iostat_blocks, args.iostat_devices, ampm=True),
+                             'parse_iostat.py', ['-t', 'UTC'], iostat_stages)
+    result['iostat-sysstat12'] = (partial(generators.iostat_lines, args.iostat_blocks, args.iostat_devices, sysstat=12),
+                                  'parse_iostat.py', ['-t', 'UTC'], iostat_stages)
+    result['serverstatus-wt'] = (partial(generators.serverstatus_lines, args.documents), 'parse_serverstatus.py', [],
+                                 serverstatus_stages)
+    result['serverstatus-mmapv1'] = (partial(generators.serverstatus_lines, args.documents, wiredtiger=False),
+                                     'parse_serverstatus.py', [], serverstatus_stages)
+    result['serverstatus-discover'] = (partial(generators.serverstatus_lines, args.documents), 'parse_serverstatus.py',
+                                       ['--discover'], partial(serverstatus_stages, discover=True))
+    return result
+
+
+def run_end_to_end(script, extra_args, path, sink):
+    """Run a parser script against the sink. Returns (seconds, points written, peak RSS in MB)."""
+    sink.reset()
+    command = [sys.executable, os.path.join(_ROOT, script), '-p', 'bench', '-i', '127.0.0.1', '-d', 'bench'] + extra_args + [path]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # wait4() rather than wait(), for the child's resource usage
+    pid, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError("{} exited with status {}".format(' '.join(command), process.returncode))
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, sink.points, usage.ru_maxrss / 1024
+
+
+def run_stages(stages, path, batch_size):
+    """Time each stage over the output of the previous one. Returns [(stage, seconds, items out)]."""
+    timings = []
+    start = time.perf_counter()
+    lines = [line for line, offset in read_lines(path)]
+    timings.append(('read', time.perf_counter() - start, len(lines)))
+    parse, encode = stages()
+    start = time.perf_counter()
+    records = parse(lines)
+    timings.append(('parse', time.perf_counter() - start, len(records)))
+    start = time.perf_counter()
+    points = encode(records)
+    timings.append(('encode', time.perf_counter() - start, len(points)))
+    client_factory = partial(InfluxDBSink, host='127.0.0.1', port=8086, database='bench')
+    start = time.perf_counter()
+    with PointWriter(_logger, client_factory) as writer:
+        for i in range(0, len(points), batch_size):
+            writer.write(points[i:i + batch_size], i)
+    timings.append(('write', time.perf_counter() - start, len(points)))
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the parsers end to end and per stage on synthetic input')
+    parser.add_argument('-l', '--lines', default=100000, type=int, help="Number of mongod.log lines per log workload.")
+    parser.add_argument('--iostat-blocks', default=10000, type=int, help="Number of iostat samples per iostat workload.")
+    parser.add_argument('--iostat-devices', default=4, type=int, help="Number of disks in each iostat sample.")
+    parser.add_argument('--documents', default=2000, type=int, help="Number of serverStatus documents per serverStatus workload.")
+    parser.add_argument('-b', '--batch-size', default=5000, type=int, help="Points per batch in the write stage.")
+    parser.add_argument('-k', '--filter', default='', help="Only run workloads whose name contains this - e.g. 'operations' or 'iostat-ampm'.")
+    parser.add_argument('--data-dir', help="Directory to write (and keep) the generated input files in. Defaults to a temporary directory.")
+    parser.add_argument('--no-stages', action='store_true', default=False, help="Only time the parsers end to end.")
+    parser.add_argument('--stages', nargs=2, metavar=('WORKLOAD', 'FILE'), help="Time the stages of a single workload on FILE in this process, writing to a running sink.")
+    args = parser.parse_args()
+
+    if args.stages:
+        name, path = args.stages
+        line_count = sum(1 for _ in read_lines(path))
+        for stage, seconds, count in run_stages(workloads(args)[name][3], path, args.batch_size):
+            unit = 'points/s' if stage in ('encode', 'write') else 'lines/s'
+            rate = (count if unit == 'points/s' else line_count) / seconds if seconds else 0
+            print("    {:<8} {:>8.2f}s {:>11.0f} {}".format(stage, seconds, rate, unit))
+        return
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='mongo-insight-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    print("{:<22} {:>9} {:>9} {:>8} {:>11} {:>11} {:>8}".format(
+        'workload', 'lines', 'points', 'seconds', 'lines/s', 'points/s', 'peak MB'))
+    with InfluxSink() as sink:
+        for name, (lines, script, extra_args, stages) in workloads(args).items():
+            if args.filter not in name:
+                continue
+            path = os.path.join(data_dir, name + '.log')
+            line_count = generators.write_file(path, lines())
+            elapsed, points, peak = run_end_to_end(script, extra_args, path, sink)
+            print("{:<22} {:>9} {:>9} {:>8.2f} {:>11.0f} {:>11.0f} {:>8.1f}".format(
+                name, line_count, points, elapsed, line_count / elapsed, points / elapsed, peak))
+            if stages and not args.no_stages:
+                sys.stdout.flush()
+                subprocess.check_call([sys.executable, __file__, '--stages', name, path, '--batch-size', str(args.batch_size)])
+    if not args.data_dir:
+        for name in os.listdir(data_dir):
+            os.remove(os.path.join(data_dir, name))
+        os.rmdir(data_dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Compare dateutil's generic parser with timestamps.TimestampParser on each of the mongod timestamp formats.
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dateutil.parser import parse
+from line_protocol import timestamp_to_ns
+from timestamps import TimestampParser
+
+__author__ = 'victorhooi'
+
+_START = datetime(2015, 8, 16, 22, 28, 15)
+
+_FORMATS = {
+    '3.x': lambda t: t.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(t.microsecond // 1000),
+    '2.6': lambda t: t.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}-0700'.format(t.microsecond // 1000),
+    '2.4': lambda t: t.strftime('%a %b %d %H:%M:%S.') + '{:03d}'.format(t.microsecond // 1000),
+}
+
+
+def sample_timestamps(formatter, count):
+    return [formatter(_START + timedelta(milliseconds=i * 37)) for i in range(count)]
+
+
+def time_it(function, timestamps):
+    start = time.perf_counter()
+    for timestamp in timestamps:
+        function(timestamp)
+    return len(timestamps) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark timestamp parsing against dateutil')
+    parser.add_argument('-c', '--count', default=100000, type=int, help="Number of timestamps to parse per format.")
+    args = parser.parse_args()
+
+    print("{:<6} {:>16} {:>16} {:>8}".format('format', 'dateutil/s', 'parser/s', 'speedup'))
+    for name, formatter in sorted(_FORMATS.items()):
+        timestamps = sample_timestamps(formatter, args.count)
+        baseline = time_it(lambda t: timestamp_to_ns(parse(t)), timestamps)
+        fast = time_it(TimestampParser(year=_START.year).parse, timestamps)
+        print("{:<6} {:>16.0f} {:>16.0f} {:>7.1f}x".format(name, baseline, fast, fast / baseline))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""
+Deterministic generators for synthetic input files - mongod logs, iostat output and serverStatus documents.
+
+Each generator is seeded, so the same arguments always produce the same file, and benchmark runs can be compared
+with each other.
+"""
+import heapq
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from serverstatus_metrics import common_metrics, mmapv1_metrics, wiredtiger_metrics
+
+__author__ = 'victorhooi'
+
+_START = datetime(2015, 8, 16, 22, 28, 15, tzinfo=timezone.utc)
+
+LOG_VERSIONS = ['2.4', '2.6', '3.x']
+
+_NAMESPACES = ['shop.orders', 'shop.customers', 'shop.products', 'analytics.events', 'admin.$cmd']
+_COMPONENTS = {'query': 'QUERY', 'getmore': 'QUERY', 'command': 'COMMAND', 'insert': 'WRITE', 'update': 'WRITE',
+               'remove': 'WRITE'}
+_PLANS = ['IXSCAN { customer_id: 1 }', 'COLLSCAN', 'IXSCAN { _id: 1 }', 'IDHACK', 'COUNT_SCAN { status: 1 }']
+
+
+def _timestamp(version, when):
+    """Format a datetime the way a given mongod version writes it at the start of a log line."""
+    milliseconds = '{:03d}'.format(when.microsecond // 1000)
+    if version == '2.4':
+        return when.strftime('%a %b ') + '{:2d} '.format(when.day) + when.strftime('%H:%M:%S.') + milliseconds
+    if version == '2.6':
+        # Written in the server's local time, with the offset
+        return (when - timedelta(hours=7)).strftime('%Y-%m-%dT%H:%M:%S.') + milliseconds + '-0700'
+    return when.strftime('%Y-%m-%dT%H:%M:%S.') + milliseconds + 'Z'
+
+
+def _prefix(version, when, component, thread):
+    if version == '3.x':
+        return '{} I {:<8} [{}] '.format(_timestamp(version, when), component, thread)
+    return '{} [{}] '.format(_timestamp(version, when), thread)
+
+
+def _locks(rng, operation):
+    """A 3.x locks:{...} section - intent locks on each resource, with the odd wait on the database lock."""
+    mode = 'r' if operation in ('query', 'getmore', 'command') else 'w'
+    database = 'acquireCount: {{ {}: {} }}'.format(mode, rng.randint(1, 3))
+    if rng.random() < 0.2:
+        database += ', acquireWaitCount: {{ {}: 1 }}, timeAcquiringMicros: {{ {}: {} }}'.format(
+            mode, mode, rng.randint(10, 500000))
+    return ('locks:{{ Global: {{ acquireCount: {{ {}: {} }} }}, Database: {{ {} }}, '
+            'Collection: {{ acquireCount: {{ {}: 1 }} }} }}'.format(mode, rng.randint(2, 6), database, mode))
+
+
+def operation_lines(version, count, seed=0):
+    """
+    Yield count mongod.log lines from a given version ('2.4', '2.6' or '3.x'). Most are slow operations, with a
+    connection line mixed in every so often, like a real log.
+    """
+    rng = random.Random(seed)
+    when = _START
+    for i in range(count):
+        when += timedelta(milliseconds=rng.randint(1, 200))
+        thread = 'conn{}'.format(rng.randint(1, 5000))
+        if i % 10 == 9:
+            yield '{}end connection 10.0.{}.{}:{} (176 connections now open)\n'.format(
+                _prefix(version, when, 'NETWORK', thread), rng.randint(0, 255), rng.randint(0, 255), rng.randint(1024, 65535))
+            continue
+        operation = rng.choice(['query', 'query', 'query', 'getmore', 'command', 'insert', 'update', 'remove'])
+        namespace = rng.choice(_NAMESPACES)
+        duration = int(rng.expovariate(1 / 150.0)) + 100
+        if operation == 'command':
+            body = 'command {}.$cmd command: count {{ count: "{}", query: {{ status: "A" }} }}'.format(
+                namespace.split('.')[0], namespace.split('.')[1])
+        elif operation in ('query', 'getmore'):
+            body = '{} {} query: {{ customer_id: {} }}'.format(operation, namespace, rng.randint(1, 10 ** 6))
+        else:
+            body = '{} {} query: {{ _id: ObjectId(\'55d10f5b{:016x}\') }}'.format(operation, namespace, rng.getrandbits(64))
+        stats = 'ntoreturn:0 ntoskip:0 nscanned:{} nscannedObjects:{} keyUpdates:0 numYields:{}'.format(
+            rng.randint(0, 10000), rng.randint(0, 10000), rng.randint(0, 50))
+        if version == '2.4':
+            line = '{} {} locks(micros) r:{} nreturned:{} reslen:{} {}ms'.format(
+                body, stats, rng.randint(1, 100000), rng.randint(0, 100), rng.randint(20, 50000), duration)
+        elif version == '2.6':
+            line = '{} planSummary: {} {} locks(micros) r:{} nreturned:{} reslen:{} {}ms'.format(
+                body, rng.choice(_PLANS), stats, rng.randint(1, 100000), rng.randint(0, 100), rng.randint(20, 50000), duration)
+        else:
+            line = '{} planSummary: {} {} writeConflicts:0 nreturned:{} reslen:{} {} {}ms'.format(
+                body, rng.choice(_PLANS), stats, rng.randint(0, 100), rng.randint(20, 50000), _locks(rng, operation),
+                duration)
+        yield _prefix(version, when, _COMPONENTS[operation], thread) + line + '\n'
+
+
+def connection_lines(version, count, seed=0):
+    """Yield count connection open and close lines, with each connection closed some time after it was opened."""
+    rng = random.Random(seed)
+    when = _START
+    open_connections = []
+    next_id = 1
+    # A few dozen application servers, each connecting from ephemeral ports
+    clients = ['10.0.{}.{}'.format(rng.randint(0, 255), rng.randint(1, 254)) for _ in range(40)]
+    for i in range(count):
+        when += timedelta(milliseconds=rng.randint(1, 500))
+        address = '{}:{}'.format(rng.choice(clients), rng.randint(1024, 65535))
+        if open_connections and (rng.random() < 0.5 or len(open_connections) > 1000):
+            connection_id = open_connections.pop(rng.randrange(len(open_connections)))
+            yield '{}end connection {} ({} connections now open)\n'.format(
+                _prefix(version, when, 'NETWORK', 'conn{}'.format(connection_id)), address, len(open_connections))
+        else:
+            open_connections.append(next_id)
+            yield '{}connection accepted from {} #{} ({} connections now open)\n'.format(
+                _prefix(version, when, 'NETWORK', 'initandlisten'), address, next_id, len(open_connections))
+            next_id += 1
+
+
+def mongod_log_lines(version, count, seed=0):
+    """
+    Yield count slow operation lines and count connection lines, in time order, like a complete mongod.log.
+    Only for the ISO8601 timestamps of 2.6 and 3.x, which sort as text.
+    """
+    return heapq.merge(operation_lines(version, count, seed), connection_lines(version, count, seed + 1),
+                       key=lambda line: line[:23])
+
+
+def iostat_lines(blocks, devices=4, ampm=False, hostname='db1.example.com', seed=0, sysstat=10):
+    """
+    Yield the lines of `iostat -x -t` output, with blocks samples of devices disks each.
+    :param ampm: write timestamps as 06/29/2015 10:00:00 PM (some locales), rather than 06/29/15 22:00:00
+    :param sysstat: the sysstat version to lay the Device lines out as - 10 (await, rsec/s) or 12 (r_await/w_await,
+    rkB/s, discards and flushes)
+    """
+    rng = random.Random(seed)
+    yield 'Linux 2.6.32-358.56.1.el6.x86_64 ({}) \t06/29/15 \t_x86_64_\t(24 CPU)\n'.format(hostname)
+    yield '\n'
+    when = datetime(2015, 6, 29, 10, 0, 0)
+    names = ['sd' + chr(ord('a') + i) for i in range(devices)]
+    for i in range(blocks):
+        when += timedelta(seconds=1)
+        yield when.strftime('%m/%d/%Y %I:%M:%S %p' if ampm else '%m/%d/%y %H:%M:%S') + '\n'
+        yield 'avg-cpu:  %user   %nice %system %iowait  %steal   %idle\n'
+        user, system, iowait = rng.uniform(0, 60), rng.uniform(0, 20), rng.uniform(0, 10)
+        yield '         {:6.2f}    0.00  {:6.2f}  {:6.2f}    0.00  {:6.2f}\n'.format(user, system, iowait, 100 - user - system - iowait)
+        yield '\n'
+        if sysstat >= 12:
+            yield ('Device            r/s     rkB/s   rrqm/s  %rrqm r_await rareq-sz     w/s     wkB/s   wrqm/s  %wrqm w_await wareq-sz     d/s     dkB/s   drqm/s  %drqm d_await dareq-sz     f/s f_await  aqu-sz  %util\n')
+        else:
+            yield ('Device:         rrqm/s   wrqm/s     r/s     w/s   rsec/s   wsec/s avgrq-sz avgqu-sz   await  svctm  %util\n')
+        for name in names:
+            if sysstat >= 12:
+                values = [rng.uniform(0, 500), rng.uniform(0, 4000), rng.uniform(0, 10), rng.uniform(0, 10), rng.uniform(0, 20),
+                          rng.uniform(4, 64), rng.uniform(0, 500), rng.uniform(0, 4000), rng.uniform(0, 50), rng.uniform(0, 10),
+                          rng.uniform(0, 20), rng.uniform(4, 64), 0, 0, 0, 0, 0, 0, rng.uniform(0, 5), rng.uniform(0, 2),
+                          rng.uniform(0, 4), rng.uniform(0, 100)]
+            else:
+                values = [rng.uniform(0, 10), rng.uniform(0, 50), rng.uniform(0, 500), rng.uniform(0, 500), rng.uniform(0, 8000),
+                          rng.uniform(0, 8000), rng.uniform(8, 64), rng.uniform(0, 4), rng.uniform(0, 20), rng.uniform(0, 2),
+                          rng.uniform(0, 100)]
+            yield '{:<14}'.format(name) + ''.join('{:9.2f}'.format(value) for value in values) + '\n'
+        yield '\n'
+
+
+def serverstatus_document(sample=0, wiredtiger=True, extra_fields=0, pid=1234):
+    """
+    A serverStatus document with every metric in serverstatus_metrics.py (mostly counters that grow with sample),
+    plus extra_fields fields that we don't extract. Without wiredtiger, it has the MMAPv1 sections instead.
+    """
+    document = {'host': 'db1.example.com:27017', 'version': '3.0.5', 'pid': {'floatApprox': pid},
+                'uptime': 10 + sample, 'localTime': (_START + timedelta(seconds=sample)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'storageEngine': {'name': 'wiredTiger' if wiredtiger else 'mmapv1'}}
+    for metrics in (common_metrics, wiredtiger_metrics if wiredtiger else mmapv1_metrics):
+        for i, location in enumerate(metrics.values()):
+            node = document
+            for key in location[:-1]:
+                node = node.setdefault(key, {})
+            value = i * 1000 + sample * (i + 1)
+            node[location[-1]] = {'floatApprox': value} if i % 3 == 0 else value
+    section = document['wiredTiger' if wiredtiger else 'extra_info']
+    for i in range(extra_fields):
+        section.setdefault('unused section {}'.format(i % 20), {})['unused statistic {}'.format(i)] = i
+    document['locks'] = {name: {'acquireCount': {'r': sample, 'w': 2, 'R': 3, 'W': 4}}
+                         for name in ('Global', 'Database', 'Collection')}
+    return document
+
+
+def serverstatus_lines(count, wiredtiger=True, extra_fields=500):
+    """Yield count serverStatus documents, one per line, sampled a second apart."""
+    for sample in range(count):
+        yield json.dumps(serverstatus_document(sample, wiredtiger, extra_fields)) + '\n'
+
+
+def write_file(path, lines):
+    """Write lines to path, returning the number of lines written."""
+    count = 0
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line)
+            count += 1
+    return count
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+A local stand-in for InfluxDB's HTTP write endpoint, which counts the points it is sent and throws them away.
+
+Benchmarks run it in a background thread (see InfluxSink), so the parsers can be timed end to end without an
+InfluxDB server - the time measured is our own, not InfluxDB's. It can also be run on its own, and prints its
+counts on Ctrl-C.
+"""
+import argparse
+import gzip
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__author__ = 'victorhooi'
+
+
+class _WriteHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        sent = len(body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if body:
+            # One point per line - line protocol doesn't need a trailing newline
+            self.server.sink.record(body.count(b'\n') + (not body.endswith(b'\n')), len(body), sent)
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        # /ping and /query, so that clients checking the server is up are happy
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InfluxSink:
+    """Counts of what's been written to the sink, and the HTTP server running it."""
+    def __init__(self, host='127.0.0.1', port=8086):
+        self.points = 0
+        self.requests = 0
+        self.bytes = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _WriteHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def record(self, points, size, sent):
+        """Count a request of points, size bytes of line protocol, which took sent bytes (compressed or not)."""
+        with self._lock:
+            self.points += points
+            self.requests += 1
+            self.bytes += size
+            self.bytes_sent += sent
+
+    def reset(self):
+        with self._lock:
+            self.points = self.requests = self.bytes = self.bytes_sent = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='influx-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def summary(self):
+        return "{} points in {} requests ({:.1f} MB, {:.1f} MB sent)".format(
+            self.points, self.requests, self.bytes / 1024 / 1024, self.bytes_sent / 1024 / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a stand-in InfluxDB that counts and discards points')
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. Defaults to 127.0.0.1.")
+    parser.add_argument('--port', default=8086, type=int, help="Port to listen on. Defaults to 8086.")
+    args = parser.parse_args()
+    sink = InfluxSink(args.host, args.port).start()
+    try:
+        sink._thread.join()
+    except KeyboardInterrupt:
+        pass
+    print(sink.summary())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
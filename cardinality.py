@@ -0,0 +1,156 @@
+import hashlib
+import math
+
+__author__ = 'victorhooi'
+
+OTHER = 'other'
+
+# SeriesCounter has 2 ** _PRECISION registers - 4096, for a count within about 1.6%
+_PRECISION = 12
+_REGISTERS = 1 << _PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / _REGISTERS)
+
+
+def add_cardinality_arguments(parser):
+    parser.add_argument('--tag-to-field', action='append', default=[], metavar='TAG', help='Write this tag (e.g. connection_id) as a field instead, so that it doesn\'t create a new series per value. Can be given more than once.')
+    parser.add_argument('--strip-port', action='append', default=[], metavar='TAG', help='Strip the port from this tag\'s host:port values (e.g. socket_address), leaving the client\'s address. Can be given more than once.')
+    parser.add_argument('--max-tag-values', default=None, type=int, help='Once a tag has had this many distinct values, write any new ones as "other".')
+
+
+def strip_port(address):
+    """'10.0.20.7:55317' -> '10.0.20.7', '[::1]:55317' -> '::1'. Anything else is returned unchanged."""
+    host, separator, port = address.rpartition(':')
+    if not separator or not port.isdigit():
+        return address
+    if host.startswith('[') and host.endswith(']'):
+        return host[1:-1]
+    if ':' in host:
+        # A bare IPv6 address, without a port
+        return address
+    return host
+
+
+class SeriesCounter:
+    """
+    An estimate of the number of distinct series in a measurement (a HyperLogLog), in 4KB however many there are -
+    keeping every tag set seen would grow with every connection_id and socket_address.
+
+    Series are hashed with BLAKE2 rather than hash(), so that counters from separate worker processes hash them the
+    same way, and can be merged by taking the larger of each register - which gives exactly the counter of all of
+    their series together. The estimate is kept up to date as registers change, so reading it costs nothing.
+    """
+    __slots__ = ('registers', 'estimate', '_total', '_zeros')
+
+    def __init__(self):
+        self.registers = bytearray(_REGISTERS)
+        # Sum of 2 ** -register, and the number of registers still at zero
+        self._total = float(_REGISTERS)
+        self._zeros = _REGISTERS
+        self.estimate = 0
+
+    def add(self, key):
+        """Add a series (any hashable value with a stable repr()). Returns True if the estimate may have changed."""
+        hashed = int.from_bytes(hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest(), 'little')
+        index = hashed & (_REGISTERS - 1)
+        # Position of the lowest set bit of the rest of the hash
+        rest = hashed >> _PRECISION
+        rank = (rest & -rest).bit_length() if rest else 64 - _PRECISION + 1
+        previous = self.registers[index]
+        if rank <= previous:
+            return False
+        self.registers[index] = rank
+        self._total += 2.0 ** -rank - 2.0 ** -previous
+        if previous == 0:
+            self._zeros -= 1
+        self._update()
+        return True
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self._total = sum(2.0 ** -register for register in self.registers)
+        self._zeros = self.registers.count(0)
+        self._update()
+
+    def _update(self):
+        estimate = _ALPHA * _REGISTERS * _REGISTERS / self._total
+        if estimate <= 2.5 * _REGISTERS and self._zeros:
+            # Linear counting, which is far more accurate for small counts
+            estimate = _REGISTERS * math.log(_REGISTERS / self._zeros)
+        self.estimate = round(estimate)
+
+
+class TagGuard:
+    """
+    Keeps the number of series written to InfluxDB in check, by rewriting each point's tags before it is encoded.
+
+    Tags can be moved to fields, host:port tags can have the (ephemeral) port stripped, and each tag can be capped
+    to a number of distinct values, after which new values are written as "other". The series seen for each
+    measurement are counted, and logged each time a measurement's count doubles (from 1000), so runaway
+    cardinality shows up while a file is being loaded rather than afterwards. Counts are estimates (see
+    SeriesCounter), so that memory use doesn't grow with them.
+    """
+    def __init__(self, logger, tags_to_fields=(), strip_ports=(), max_values=None):
+        self.logger = logger
+        self.tags_to_fields = set(tags_to_fields)
+        self.strip_ports = set(strip_ports)
+        self.max_values = max_values
+        # tag: set of the values we've let through - at most max_values of them
+        self._values = {}
+        # measurement: SeriesCounter
+        self._series = {}
+        self._report_at = {}
+
+    @classmethod
+    def for_args(cls, args, logger):
+        return cls(logger, args.tag_to_field, args.strip_port, args.max_tag_values)
+
+    def apply(self, measurement_name, fields, tags, count=True):
+        """Return the (fields, tags) to write for a point, and count its series (unless it won't be written)."""
+        if tags:
+            tags = dict(tags)
+            for key in self.tags_to_fields.intersection(tags):
+                value = tags.pop(key)
+                if value is not None:
+                    fields = dict(fields, **{key: value})
+            for key in self.strip_ports.intersection(tags):
+                if tags[key]:
+                    tags[key] = strip_port(tags[key])
+            if self.max_values is not None:
+                for key, value in tags.items():
+                    seen = self._values.setdefault(key, set())
+                    if value not in seen:
+                        if len(seen) < self.max_values:
+                            seen.add(value)
+                        else:
+                            tags[key] = OTHER
+        if count:
+            self.count(measurement_name, tags)
+        return fields, tags
+
+    def count(self, measurement_name, tags):
+        series = self._series.get(measurement_name)
+        if series is None:
+            series = self._series[measurement_name] = SeriesCounter()
+        if series.add(tuple(sorted(tags.items())) if tags else ()):
+            self._check(measurement_name, series)
+
+    def _check(self, measurement_name, series):
+        if series.estimate >= self._report_at.get(measurement_name, 1000):
+            self.logger.warning("{} now has about {} series".format(measurement_name, series.estimate))
+            self._report_at[measurement_name] = series.estimate * 2
+
+    def merge_series(self, series):
+        """Count the series from another TagGuard's series_counters() - e.g. one from a worker process."""
+        for measurement_name, counter in series.items():
+            own = self._series.get(measurement_name)
+            if own is None:
+                own = self._series[measurement_name] = SeriesCounter()
+            own.merge(counter)
+            self._check(measurement_name, own)
+
+    def series_counters(self):
+        return self._series
+
+    def summary(self):
+        return ', '.join("{}: about {} series".format(measurement_name, series.estimate)
+                         for measurement_name, series in sorted(self._series.items()))
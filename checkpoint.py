@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+from inputs import compression
+
+__author__ = 'victorhooi'
+
+
+def add_checkpoint_arguments(parser):
+    parser.add_argument('--checkpoint', help='File to record the last batch written to InfluxDB in, so that a run can be resumed from there. Defaults to <input_file>.checkpoint with --follow or --resume.')
+    parser.add_argument('--resume', action='store_true', default=False, help='Carry on from the last batch recorded in the checkpoint file, rather than from the start of the input file. Always on with --follow.')
+
+
+def hash_range(path, start, end):
+    """Return the SHA-1 of the bytes of path between start and end."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(remaining, 1024 * 1024))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """
+    The last batch of an input file that has been durably written - its byte range, the line number it ends on, and
+    a hash of its contents - saved to a small JSON file.
+
+    The writer calls save() as batches complete (see PointWriter's on_durable), so a resumed run never skips a batch
+    that didn't make it to InfluxDB. The hash lets us check, on resume, that the input file is the one we were
+    reading, rather than a new file that happens to be at least as long.
+
+    Offsets into compressed files are into the decompressed data, which can only be reached by decompressing
+    everything before them - so for those, the hash is of the start of the (compressed) file instead.
+    """
+    def __init__(self, path, input_file):
+        self.path = path
+        self.input_file = input_file
+        self.offset = 0
+        self.line_number = 0
+        self.compressed = compression(input_file) is not None
+        self._head_hash = None
+
+    def _hash(self, start, end):
+        if self.compressed:
+            if self._head_hash is None:
+                self._head_hash = hash_range(self.input_file, 0, 1024 * 1024)
+            return self._head_hash
+        return hash_range(self.input_file, start, end)
+
+    @classmethod
+    def for_args(cls, args, logger):
+        """Return the Checkpoint for a parser's arguments (loaded if we're resuming), or None if we aren't checkpointing."""
+        resume = args.resume or args.follow
+        path = args.checkpoint or (args.input_file + '.checkpoint' if resume else None)
+        if path is None:
+            return None
+        checkpoint = cls(path, args.input_file)
+        if resume:
+            checkpoint.load(logger)
+        return checkpoint
+
+    def load(self, logger):
+        """Load the saved position, unless the input file has been replaced or changed since it was saved."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return self
+        stat = os.stat(self.input_file)
+        if saved['inode'] != stat.st_ino or (saved['offset'] > stat.st_size and not self.compressed) or \
+                self._hash(saved['start'], saved['offset']) != saved['sha1']:
+            logger.warning("{} no longer matches {} - starting from the beginning".format(self.input_file, self.path))
+            return self
+        self.offset = saved['offset']
+        self.line_number = saved['line_number']
+        logger.info("Resuming {} from line {} (byte {})".format(self.input_file, self.line_number, self.offset))
+        return self
+
+    def save(self, position):
+        """
+        Record a batch as written.
+        :param position: (start, end, line_number) - the batch's byte range in the input file, and its last line
+        """
+        start, end, line_number = position
+        if start > end:
+            # The file was rotated part way through the batch
+            start = 0
+        self.offset = end
+        self.line_number = line_number
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'input_file': self.input_file, 'inode': os.stat(self.input_file).st_ino, 'start': start,
+                       'offset': end, 'line_number': line_number, 'sha1': self._hash(start, end)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # Replace the old checkpoint in one step, so a crash can't leave a half-written file behind
+        os.replace(temp_path, self.path)
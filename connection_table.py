@@ -0,0 +1,64 @@
+from collections import OrderedDict
+
+__author__ = 'victorhooi'
+
+
+class ConnectionTable:
+    """
+    Start times of the connections that are currently open, keyed by integer connection id.
+
+    Entries are removed as soon as the connection closes, and connections that have been open for longer than the
+    TTL are aged out - mongod logs are in time order, so the oldest entries are always at the front (a reused id is
+moved to the back). Totals are kept
+    as counters, so memory use depends on how many connections are open at once, not on the length of the log.
+    """
+    __slots__ = ('ttl', '_start_times', 'opened', 'closed', 'matched', 'expired', 'peak_open')
+
+    def __init__(self, ttl=None):
+        """
+        :param ttl: age (in nanoseconds, like the timestamps) after which an open connection is forgotten
+        """
+        self.ttl = ttl
+        self._start_times = OrderedDict()
+        self.opened = 0
+        self.closed = 0
+        self.matched = 0
+        self.expired = 0
+        self.peak_open = 0
+
+    def __len__(self):
+        return len(self._start_times)
+
+    def open(self, connection_id, timestamp):
+        self._expire(timestamp)
+        # Ids start again from 1 when mongod restarts - an id that's still open was never seen to close, so it's
+        # counted as expired, and moved to the back with its new start time to keep the table in time order
+        if self._start_times.pop(connection_id, None) is not None:
+            self.expired += 1
+        self._start_times[connection_id] = timestamp
+        self.opened += 1
+        self.peak_open = max(self.peak_open, len(self._start_times))
+
+    def close(self, connection_id, timestamp):
+        """Forget a connection, returning when it was opened - or None if we didn't see it open."""
+        self._expire(timestamp)
+        self.closed += 1
+        start_time = self._start_times.pop(connection_id, None)
+        if start_time is not None:
+            self.matched += 1
+        return start_time
+
+    def _expire(self, timestamp):
+        if self.ttl is None:
+            return
+        start_times = self._start_times
+        while start_times:
+            connection_id, start_time = next(iter(start_times.items()))
+            if timestamp - start_time <= self.ttl:
+                break
+            start_times.popitem(last=False)
+            self.expired += 1
+
+    def summary(self):
+        return "{} connections opened, {} closed ({} matched an open), {} expired, {} still open, at most {} open at once".format(
+            self.opened, self.closed, self.matched, self.expired, len(self), self.peak_open)
@@ -0,0 +1,52 @@
+__author__ = 'victorhooi'
+
+
+class CounterRates:
+    """
+    Per-second rates of counter metrics, from consecutive serverStatus samples of the same mongod.
+
+    Only the previous sample of each host is kept. A new pid, or uptime going backwards, means mongod has restarted
+    and its counters have gone back to zero, so no rates are produced for the first sample after a restart. A single
+    counter going backwards (e.g. wrapping around) just has its rate left out.
+    """
+    def __init__(self, counters):
+        """
+        :param counters: dict of measurement name to the set of metric names in it that are counters
+        """
+        self.counters = counters
+        # host: (pid, uptime, timestamp, {measurement_name: values})
+        self._previous = {}
+        self.resets = 0
+
+    def update(self, host, pid, uptime, timestamp, measurements):
+        """
+        Record a sample, and return [(measurement_name, rates)] since the previous sample from the same host.
+        :param timestamp: nanoseconds since the epoch
+        :param measurements: {measurement_name: {metric_name: value}}, as from MetricPlan.extract()
+        """
+        previous = self._previous.get(host)
+        self._previous[host] = (pid, uptime, timestamp, measurements)
+        if previous is None:
+            return []
+        previous_pid, previous_uptime, previous_timestamp, previous_measurements = previous
+        if pid != previous_pid or (uptime is not None and previous_uptime is not None and uptime < previous_uptime):
+            self.resets += 1
+            return []
+        seconds = (timestamp - previous_timestamp) / 1e9
+        if seconds <= 0:
+            return []
+        result = []
+        for measurement_name, values in measurements.items():
+            counters = self.counters.get(measurement_name)
+            previous_values = previous_measurements.get(measurement_name)
+            if not counters or not previous_values:
+                continue
+            rates = {}
+            for metric_name, value in values.items():
+                if metric_name in counters:
+                    previous_value = previous_values.get(metric_name)
+                    if previous_value is not None and value >= previous_value:
+                        rates[metric_name] = (value - previous_value) / seconds
+            if rates:
+                result.append((measurement_name, rates))
+        return result
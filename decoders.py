@@ -0,0 +1,167 @@
+import json
+import re
+
+__author__ = 'victorhooi'
+
+# Faster JSON libraries are optional - we use the first one that's installed, and fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+_SCALAR = re.compile(r'[^,}\]\s]+')
+_BRACKET = re.compile(r'[{}\[\]]')
+_STRUCTURE = re.compile(r'["{}\[\]]')
+_stdlib_decoder = json.JSONDecoder()
+
+
+def _skip_value(text, index):
+    """Return the index just past the JSON value starting at index, without decoding it."""
+    c = text[index]
+    if c == '"':
+        return _STRING.match(text, index).end()
+    if c not in '{[':
+        return _SCALAR.match(text, index).end()
+    # Jump from bracket to bracket. A bracket preceded by an odd number of quotes is inside a string, and escaped
+    # quotes would throw the count off - both are rare in serverStatus, so we then fall back to the exact scan.
+    start = index
+    depth = 0
+    while True:
+        match = _BRACKET.search(text, index)
+        if not match:
+            raise ValueError("Unterminated JSON value")
+        position = match.start()
+        if text.count('"', index, position) % 2:
+            return _skip_value_exact(text, start)
+        depth += 1 if match.group() in '{[' else -1
+        index = position + 1
+        if depth == 0:
+            if text.find('\\', start, index) != -1:
+                return _skip_value_exact(text, start)
+            return index
+
+
+def _skip_value_exact(text, index):
+    """Like _skip_value, but steps over every string, so brackets and escaped quotes within strings are handled."""
+    depth = 0
+    while True:
+        match = _STRUCTURE.search(text, index)
+        if not match:
+            raise ValueError("Unterminated JSON value")
+        c = match.group()
+        if c == '"':
+            match = _STRING.match(text, match.start())
+            if not match:
+                raise ValueError("Unterminated string")
+            index = match.end()
+            continue
+        depth += 1 if c in '{[' else -1
+        index = match.end()
+        if depth == 0:
+            return index
+
+
+class PartialDecoder:
+    """
+    Decodes only the parts of a JSON document named in a set of paths.
+
+    Values outside those paths are skipped over without being turned into Python objects, which keeps the memory
+    used per document down - a full serverStatus has thousands of fields, but we only read a couple of hundred.
+    Values at the end of a path are decoded in full (with the standard library's C decoder). Sub-documents that
+    only contain wanted values (like each wiredTiger section) are decoded in C too, and then pruned.
+    """
+    def __init__(self, paths):
+        """
+        :param paths: list of key lists - e.g. ['wiredTiger', 'cache', 'bytes read into cache']
+        """
+        self.tree = {}
+        for path in paths:
+            node = self.tree
+            for key in path[:-1]:
+                node = node.setdefault(key, {})
+                if node is None:
+                    # A shorter path already asks for this whole sub-document
+                    break
+            else:
+                node[path[-1]] = None
+        self._leaf_parents = set()
+        self._find_leaf_parents(self.tree)
+
+    def _find_leaf_parents(self, tree):
+        if all(subtree is None for subtree in tree.values()):
+            self._leaf_parents.add(id(tree))
+        for subtree in tree.values():
+            if subtree is not None:
+                self._find_leaf_parents(subtree)
+
+    def decode(self, text):
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        try:
+            index = _WHITESPACE.match(text, 0).end()
+            if text[index] != '{':
+                raise ValueError("Expected a JSON object")
+            document, index = self._decode_object(text, index, self.tree)
+        except IndexError:
+            raise ValueError("Truncated JSON document")
+        return document
+
+    def _decode_object(self, text, index, tree):
+        document = {}
+        index = _WHITESPACE.match(text, index + 1).end()
+        if text[index] == '}':
+            return document, index + 1
+        while True:
+            match = _STRING.match(text, index)
+            if not match:
+                raise ValueError("Expected a key at position {}".format(index))
+            key = match.group()
+            key = json.loads(key) if '\\' in key else key[1:-1]
+            index = _WHITESPACE.match(text, match.end()).end()
+            if text[index] != ':':
+                raise ValueError("Expected ':' at position {}".format(index))
+            index = _WHITESPACE.match(text, index + 1).end()
+            if key in tree:
+                subtree = tree[key]
+                if subtree is None or text[index] != '{':
+                    document[key], index = _stdlib_decoder.raw_decode(text, index)
+                elif id(subtree) in self._leaf_parents:
+                    value, index = _stdlib_decoder.raw_decode(text, index)
+                    document[key] = {name: value[name] for name in subtree if name in value}
+                else:
+                    document[key], index = self._decode_object(text, index, subtree)
+            else:
+                index = _skip_value(text, index)
+            index = _WHITESPACE.match(text, index).end()
+            c = text[index]
+            if c == ',':
+                index = _WHITESPACE.match(text, index + 1).end()
+            elif c == '}':
+                return document, index + 1
+            else:
+                raise ValueError("Expected ',' or '}}' at position {}".format(index))
+
+
+def get_decoder(name='auto', paths=None):
+    """
+    Return a function that decodes a JSON document (str or bytes). Decoding errors are raised as ValueError.
+    :param name: 'auto' (the fastest installed library), 'orjson', 'ujson', 'json' (standard library), or 'partial'
+    :param paths: for 'partial', the key paths to decode - see PartialDecoder
+    """
+    if name == 'partial':
+        return PartialDecoder(paths).decode
+    if name == 'auto':
+        name = 'orjson' if orjson else 'ujson' if ujson else 'json'
+    if name == 'orjson' and orjson:
+        return orjson.loads
+    if name == 'ujson' and ujson:
+        return ujson.loads
+    if name == 'json':
+        return json.loads
+    raise ValueError("JSON decoder \"{}\" is not available".format(name))
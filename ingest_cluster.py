@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import shlex
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from timestamps import detect_format
+from inputs import compression, open_input
+import ingest_log
+import parse_iostat
+import parse_serverstatus
+
+__author__ = 'victorhooi'
+
+# The script that loads each kind of input file - anything with a module level parser (for its options), and a
+# load(parser, args, logger) generator of (points, line number, position) batches.
+LOADERS = {
+    'log': ingest_log,
+    'serverstatus': parse_serverstatus,
+    'iostat': parse_iostat,
+}
+
+# Files the scripts keep next to their input files, which aren't inputs themselves
+_SIDE_FILES = ('.checkpoint', '.deadletter', '.timeindex', '.tmp')
+
+# mongod logs its hostname as it starts up - e.g. (3.x):
+# 2015-08-16T22:28:00.000Z I CONTROL  [initandlisten] MongoDB starting : pid=1234 port=27017 dbpath=/data 64-bit host=db1
+_STARTUP_HOST = re.compile(r'\] MongoDB starting : .* host=(\S+)')
+
+# How many lines at the start of a log to look for the startup line in
+_HOST_SEARCH_LINES = 1000
+
+_DOCUMENT_HOST = re.compile(r'"host"\s*:\s*"([^":]+)')
+
+# Options of the scripts that only their main() acts on - each file is loaded once, from start to end, so these
+# can't be given for a file in a manifest
+_MAIN_ONLY_OPTIONS = ('follow', 'resume', 'checkpoint', 'since', 'until', 'time_index')
+
+
+parser = argparse.ArgumentParser(description='Load the mongod logs, serverStatus output and iostat output of a whole cluster into an InfluxDB instance, parsing several files at once')
+parser.add_argument('-d', '--database', default="insight", help="Name of InfluxDB database to write to. Defaults to 'insight'.")
+parser.add_argument('-p', '--project', required=True, help='Project name to tag this with')
+parser.add_argument('-t', '--timezone', default='UTC', help='Timezone of the source systems, for 2.4 loglines and iostat output - e.g. "UTC", "US/Eastern", or "US/Pacific". Defaults to UTC.')
+parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
+parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=8, type=int, help='Number of concurrent threads writing to InfluxDB, shared by every file. Defaults to 8.')
+add_sink_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <inputs>.deadletter, or ingest_cluster.deadletter in the inputs directory.')
+parser.add_argument('--workers', default=os.cpu_count(), type=int, help='Number of files to parse at once, each in its own process. Defaults to the number of CPUs.')
+parser.add_argument('--progress-interval', default=10, type=float, help='Seconds between progress reports. Defaults to 10.')
+parser.add_argument('inputs', help='A directory to load every mongod log, serverStatus and iostat file under, or a manifest file listing them - see the README.')
+
+
+class InputFile:
+    """
+    A file to load - what kind it is, the host it came from, and any options for its script. serverStatus documents
+    name their own host, so the hostname of those is only for progress reports.
+    """
+    def __init__(self, path, kind, hostname=None, options=()):
+        self.path = path
+        self.kind = kind
+        self.hostname = hostname
+        self.options = list(options)
+        # The file's script's parsed arguments
+        self.args = None
+        self.size = os.path.getsize(path)
+        self.compressed = compression(path) is not None
+        # Progress, as reported by the worker parsing it
+        self.line_number = 0
+        self.offset = 0
+        self.points = 0
+        self.started = None
+        self.finished = False
+
+    def __repr__(self):
+        return "{} {} {}".format(self.hostname or '-', self.kind, self.path)
+
+    def parse_args(self, args):
+        """
+        Parse the arguments for the file's script - our own, plus the file's options. Raises ValueError for options
+        we can't act on.
+        """
+        script_args = ['-p', args.project]
+        if self.kind != 'serverstatus':
+            # serverStatus documents have the host in them
+            script_args += ['-t', args.timezone]
+            if self.hostname:
+                script_args += ['-n', self.hostname]
+        self.args = LOADERS[self.kind].parser.parse_args(script_args + self.options + [self.path])
+        unsupported = [name for name in _MAIN_ONLY_OPTIONS if getattr(self.args, name, None)]
+        if unsupported:
+            raise ValueError("{} - {} can't be used here, as every file is loaded once, from start to end".format(
+                self, ', '.join('--' + name.replace('_', '-') for name in unsupported)))
+
+    def progress(self):
+        if self.compressed:
+            # Offsets are into the decompressed data, so there's no telling how far through the file they are
+            done = "{:.0f}MB".format(self.offset / 1024 / 1024)
+        else:
+            done = "{:.0f}%".format(self.offset / self.size * 100 if self.size else 100)
+        return "{} - {} ({} lines, {} points)".format(self, done, self.line_number, self.points)
+
+
+def detect_kind(path):
+    """Return the kind of input a file is - 'log', 'serverstatus' or 'iostat' - going by its first line, or None."""
+    try:
+        with open_input(path) as f:
+            line = f.readline(64 * 1024).decode('utf-8', errors='replace')
+    except (OSError, EOFError, ValueError):
+        return None
+    if line.startswith('{'):
+        return 'serverstatus'
+    if line.startswith('Linux '):
+        return 'iostat'
+    try:
+        detect_format(line)
+    except ValueError:
+        return None
+    return 'log'
+
+
+def infer_hostname(path, kind):
+    """
+    Return the hostname recorded in an input file - in mongod's startup line near the start of a log, the header of
+    iostat output, or the first serverStatus document - or None if there isn't one.
+    """
+    with open_input(path) as f:
+        if kind == 'iostat':
+            # Linux 2.6.32-358.56.1.el6.x86_64 (db1.example.com) 	06/29/15 	_x86_64_	(24 CPU)
+            parts = re.split(r'[()]', f.readline().decode('utf-8', errors='replace'))
+            return parts[1] if len(parts) > 2 else None
+        if kind == 'serverstatus':
+            match = _DOCUMENT_HOST.search(f.readline().decode('utf-8', errors='replace'))
+            return match.group(1) if match else None
+        for line_number, line in enumerate(f):
+            if line_number >= _HOST_SEARCH_LINES:
+                break
+            match = _STARTUP_HOST.search(line.decode('utf-8', errors='replace'))
+            if match:
+                return match.group(1)
+    return None
+
+
+def scan_directory(directory, logger):
+    """
+    Return an InputFile for every input file under directory. mongod logs without a startup line are taken to be
+    from the host their directory is named after.
+    """
+    input_files = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(name for name in dirs if not name.startswith('.'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.startswith('.') or name.endswith(_SIDE_FILES):
+                continue
+            kind = detect_kind(path)
+            if kind is None:
+                logger.warning("Skipping {} - not a mongod log, serverStatus or iostat file".format(path))
+                continue
+            hostname = infer_hostname(path, kind)
+            if hostname is None and kind == 'log':
+                hostname = os.path.basename(os.path.abspath(root))
+            input_files.append(InputFile(path, kind, hostname))
+    return input_files
+
+
+def read_manifest(path):
+    """
+    Return an InputFile for every entry in a manifest - one line per file, of "<hostname> <kind> <path> [options]",
+    with '-' for a hostname or kind to be worked out from the file, and '#' starting a comment. Paths are relative to
+    the manifest, and any options are passed on to the file's script.
+    """
+    input_files = []
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            fields = shlex.split(line, comments=True)
+            if not fields:
+                continue
+            if len(fields) < 3:
+                raise ValueError("Line {} of {} should be <hostname> <kind> <path> [options]".format(line_number, path))
+            hostname, kind, input_path, options = fields[0], fields[1], fields[2], fields[3:]
+            input_path = os.path.join(base, input_path)
+            if kind == '-':
+                kind = detect_kind(input_path)
+            if kind not in LOADERS:
+                raise ValueError("Line {} of {} - {} is not a kind of file we can load (any of {})".format(
+                    line_number, path, input_path, ', '.join(LOADERS)))
+            if hostname == '-':
+                hostname = infer_hostname(input_path, kind)
+                if hostname is None and kind == 'log':
+                    raise ValueError("Line {} of {} - no hostname given, and {} has no startup line".format(
+                        line_number, path, input_path))
+            input_files.append(InputFile(input_path, kind, hostname, options))
+    return input_files
+
+
+# State for the worker processes, set up once per process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(results):
+    _worker_state['results'] = results
+    logger = logging.getLogger('ingest_cluster')
+    # Forked workers already have the parent's handler
+    _worker_state['logger'] = logger if logger.handlers else configure_logging('ingest_cluster')
+
+
+def _load_file(number, kind, args):
+    """
+    Parse one file in a worker process, putting (number, points, line number, offset) on the results queue for each
+    batch, then (number, None, line number, None) once it's done.
+    """
+    results = _worker_state['results']
+    line_number = 0
+    for points, line_number, position in LOADERS[kind].load(LOADERS[kind].parser, args, _worker_state['logger']):
+        results.put((number, points, line_number, position[1] if position else None))
+    results.put((number, None, line_number, None))
+
+
+def load_files(args, input_files, writer, logger):
+    """
+    Parse input_files (once their arguments are parsed) with a pool of worker processes - largest first, so that the longest one isn't left until last
+    - handing their points to writer as they come in. Returns the files that failed to load.
+    """
+    order = sorted(range(len(input_files)), key=lambda number: input_files[number].size, reverse=True)
+    # Bounded, so that workers wait for the writer rather than piling up points in memory
+    results = multiprocessing.Queue(maxsize=args.workers * 4)
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(results,)) as pool:
+        futures = {number: pool.submit(_load_file, number, input_files[number].kind, input_files[number].args)
+                   for number in order}
+        remaining = set(futures)
+        last_report = time.time()
+        while remaining:
+            try:
+                number, points, line_number, offset = results.get(timeout=1)
+            except queue.Empty:
+                for number in list(remaining):
+                    if futures[number].done() and futures[number].exception() is not None:
+                        logger.error("Failed to load {} - {!r}".format(input_files[number], futures[number].exception()))
+                        failed.append(input_files[number])
+                        remaining.discard(number)
+            else:
+                input_file = input_files[number]
+                if input_file.started is None:
+                    input_file.started = time.time()
+                input_file.line_number = line_number
+                if points is None:
+                    input_file.finished = True
+                    remaining.discard(number)
+                    logger.info("Finished {} in {:.0f}s".format(input_file.progress(),
+                                                                time.time() - input_file.started))
+                    continue
+                if offset is not None:
+                    input_file.offset = offset
+                input_file.points += len(points)
+                writer.write(points, line_number)
+            if time.time() - last_report >= args.progress_interval:
+                last_report = time.time()
+                for input_file in input_files:
+                    if input_file.started is not None and not input_file.finished:
+                        logger.info("Loading {}".format(input_file.progress()))
+                logger.info("{} of {} files loaded - {}".format(sum(input_file.finished for input_file in input_files),
+                                                                len(input_files), writer.stats.summary()))
+    return failed
+
+
+def main():
+    args = parser.parse_args()
+    client_factory = sink_factory(parser, args)
+    logger = configure_logging('ingest_cluster')
+    try:
+        if os.path.isdir(args.inputs):
+            input_files = scan_directory(args.inputs, logger)
+            dead_letter_file = os.path.join(args.inputs, 'ingest_cluster.deadletter')
+        else:
+            input_files = read_manifest(args.inputs)
+            dead_letter_file = args.inputs + '.deadletter'
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if not input_files:
+        parser.error("No mongod log, serverStatus or iostat files found in {}".format(args.inputs))
+    for input_file in input_files:
+        logger.info("Found {} ({:.1f}MB)".format(input_file, input_file.size / 1024 / 1024))
+        # Checks every file's options before starting on any of them
+        try:
+            input_file.parse_args(args)
+        except ValueError as e:
+            parser.error(str(e))
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter or dead_letter_file) as writer:
+        failed = load_files(args, input_files, writer, logger)
+    if failed:
+        logger.error("{} file(s) failed to load - {}".format(len(failed), ', '.join(map(str, failed))))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pytz import timezone
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from timestamps import TimestampParser
+from inputs import add_follow_arguments, batches, open_lines
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from time_window import add_time_window_arguments, ctime_years, log_time, window_for_args
+from cardinality import TagGuard, add_cardinality_arguments
+from parse_operations import OperationHandler, add_operation_arguments
+from parse_connections import ConnectionHandler, add_connection_arguments
+
+__author__ = 'victorhooi'
+
+# The handlers for each kind of line - anything with wants(line), handle(line), finished(), flush() and report(),
+# and a for_args(parser, args, timestamps, logger, guard) classmethod to create it.
+HANDLERS = {
+    'operations': OperationHandler,
+    'connections': ConnectionHandler,
+}
+
+
+parser = argparse.ArgumentParser(description='Parse a mongod.log logfile for slow operations and connections in a single pass, and load them into an InfluxDB instance')
+parser.add_argument('-b', '--batch-size', default=5000, type=int, help="Batch size to process before writing to InfluxDB.")
+parser.add_argument('-d', '--database', default="insight", help="Name of InfluxDB database to write to. Defaults to 'insight'.")
+parser.add_argument('-n', '--hostname', required=True, help='Host(Name) of the server')
+parser.add_argument('-p', '--project', required=True, help='Project name to tag this with')
+parser.add_argument('-t', '--timezone', default='UTC', help='Timezone of the source system for 2.4 loglines - e.g. "UTC", "US/Eastern", or "US/Pacific". Defaults to UTC.')
+parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
+parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <input_file>.deadletter.')
+parser.add_argument('--handlers', default=','.join(HANDLERS), help='Comma separated list of the kinds of line to load - any of {}. Defaults to all of them.'.format(', '.join(HANDLERS)))
+add_operation_arguments(parser)
+add_connection_arguments(parser)
+add_cardinality_arguments(parser)
+add_follow_arguments(parser)
+add_checkpoint_arguments(parser)
+add_time_window_arguments(parser)
+parser.add_argument('input_file')
+
+
+def ingest(lines, handlers):
+    """
+    Return the points for a batch of lines. Each line is handed to every handler that wants it - the checks are
+    cheap substring tests, so most lines are only looked at closely (and have their timestamp parsed) once.
+    """
+    points = []
+    for line in lines:
+        for handler in handlers:
+            if handler.wants(line):
+                points.extend(handler.handle(line))
+    for handler in handlers:
+        points.extend(handler.finished())
+    return points
+
+
+def load(parser, args, logger, start=0, until=None, line_count=0):
+    """
+    Yield (points, line number, position) for each batch of lines in args.input_file, between the byte offsets start
+    and until (None for the end of the file), then the handlers' last points (with no position). position is as for
+    PointWriter.write(). Once they've all been taken, the handlers report what they found.
+    """
+    names = [name.strip() for name in args.handlers.split(',') if name.strip()]
+    unknown = [name for name in names if name not in HANDLERS]
+    if unknown or not names:
+        parser.error("Unknown handler(s) {} - use any of {}".format(', '.join(unknown), ', '.join(HANDLERS)))
+    guard = TagGuard.for_args(args, logger)
+    # One timestamp parser for the file, shared by the handlers - in the year the log has reached by start
+    timestamps = TimestampParser(tz=timezone(args.timezone), year=ctime_years(args.input_file, [0, start])[-1])
+    handlers = [HANDLERS[name].for_args(parser, args, timestamps, logger, guard) for name in names]
+    for batch in batches(open_lines(args, start, until), args.batch_size, args.max_latency / 1000):
+        line_count += len(batch)
+        end = batch[-1][1]
+        yield ingest((line for line, offset in batch), handlers), line_count, (start, end, line_count)
+        start = end
+    yield [point for handler in handlers for point in handler.flush()], line_count, None
+    for handler in handlers:
+        handler.report()
+    logger.info("Series written - {}".format(guard.summary()))
+
+
+def main():
+    args = parser.parse_args()
+    client_factory = sink_factory(parser, args)
+    logger = configure_logging('ingest_log')
+    since, until = window_for_args(parser, args, log_time(args.input_file, timezone(args.timezone)), logger)
+    checkpoint = Checkpoint.for_args(args, logger)
+    start, line_count = (checkpoint.offset, checkpoint.line_number) if checkpoint and checkpoint.offset > since \
+        else (since, 0)
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter or args.input_file + '.deadletter',
+                     on_durable=checkpoint.save if checkpoint else None) as writer:
+        for points, line_count, position in load(parser, args, logger, start, until, line_count):
+            writer.write(points, line_count, position)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,159 @@
+import bz2
+import gzip
+import io
+import os
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = 'victorhooi'
+
+# Line sources yield (line, offset) tuples, where offset is the byte offset just past the line - that's where to
+# resume from once the line has been written. For compressed files, offsets are into the decompressed data. In follow
+# mode they also yield None whenever they're waiting for more data, so that batches() can flush a partial batch once
+# it's old enough.
+
+# Leading bytes of each kind of compressed file we can read
+_MAGIC = [(b'\x1f\x8b', 'gzip'), (b'BZh', 'bz2'), (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+
+def add_follow_arguments(parser):
+    parser.add_argument('-f', '--follow', action='store_true', default=False, help='Keep reading new lines as they are written to the input file, like tail -F.')
+    parser.add_argument('--max-latency', default=1000, type=int, help='In follow mode, the longest time (in ms) to hold lines before writing them. Defaults to 1000.')
+
+
+def compression(path):
+    """Return how a file is compressed - 'gzip', 'bz2' or 'zstd', going by its first few bytes - or None."""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for magic, kind in _MAGIC:
+        if head.startswith(magic):
+            return kind
+    return None
+
+
+def open_input(path):
+    """Open an input file for reading as bytes, decompressing it as it's read if it's compressed."""
+    kind = compression(path)
+    if kind == 'gzip':
+        return gzip.open(path, 'rb')
+    if kind == 'bz2':
+        return bz2.open(path, 'rb')
+    if kind == 'zstd':
+        if zstandard is None:
+            raise ValueError("{} is zstd compressed, but the zstandard module is not installed".format(path))
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
+
+
+def skip_to(f, offset):
+    """Move a file opened by open_input() on to offset - compressed files can only get there by reading up to it."""
+    if f.seekable():
+        f.seek(offset)
+        return
+    remaining = offset - f.tell()
+    while remaining > 0:
+        skipped = len(f.read(min(remaining, 1024 * 1024)))
+        if not skipped:
+            break
+        remaining -= skipped
+
+
+def read_lines(path, start=0, end=None):
+    """
+    Yield (line, offset) for each line of path between the byte offsets start and end, decompressing it if it's
+    compressed.
+    """
+    with open_input(path) as f:
+        if start:
+            skip_to(f, start)
+        offset = start
+        for line in f:
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            yield line.decode('utf-8', errors='replace'), offset
+
+
+def follow_lines(path, start=0, poll_interval=0.1):
+    """
+    Yield (line, offset) for each line of path, then wait for more to be written - forever.
+    Handles the file being rotated (renamed and recreated) or truncated in place, by starting again from the
+    beginning of the new file. A final line without a newline is held back until it is complete.
+    """
+    if compression(path):
+        raise ValueError("Can't follow {} - it is compressed".format(path))
+    f = open(path, 'rb')
+    try:
+        if start > os.fstat(f.fileno()).st_size:
+            # The file has been truncated or replaced since this offset was saved
+            start = 0
+        f.seek(start)
+        offset = start
+        pending = b''
+        while True:
+            line = f.readline()
+            if line:
+                pending += line
+                if pending.endswith(b'\n'):
+                    offset += len(pending)
+                    yield pending.decode('utf-8', errors='replace'), offset
+                    pending = b''
+                continue
+            # We're at the end of the file - check whether it's been rotated or truncated
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Between the rename and the new file being created
+                stat = None
+            if stat and stat.st_ino != os.fstat(f.fileno()).st_ino:
+                # Rotated - anything left in the old file has been read, so move on to the new one
+                f.close()
+                f = open(path, 'rb')
+                offset = 0
+                pending = b''
+                continue
+            if stat and stat.st_size < offset + len(pending):
+                f.seek(0)
+                offset = 0
+                pending = b''
+                continue
+            yield None
+            time.sleep(poll_interval)
+    finally:
+        f.close()
+
+
+def open_lines(args, start=0, end=None):
+    """
+    Return the line source for a parser's input_file, following it if --follow was given.
+    end is where to stop reading (see time_window.py) - there's no end to a followed file.
+    """
+    if args.follow:
+        return follow_lines(args.input_file, start)
+    return read_lines(args.input_file, start, end)
+
+
+def batches(items, batch_size, max_latency=None):
+    """
+    Group items into lists of up to batch_size. A None item (from a line source in follow mode) flushes the
+    current batch if its first item arrived more than max_latency seconds ago.
+    """
+    batch = []
+    started = None
+    for item in items:
+        if item is not None:
+            if not batch:
+                started = time.time()
+            batch.append(item)
+            if len(batch) < batch_size:
+                continue
+        elif not batch or max_latency is None or time.time() - started < max_latency:
+            continue
+        yield batch
+        batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,112 @@
+from itertools import groupby
+from line_protocol import escape_key, format_tags, timestamp_to_ns
+
+__author__ = 'victorhooi'
+
+# NumPy is optional - without it, parse_iostat falls back to converting each value separately
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def device_lines(block, device_pattern=None):
+    """
+    Return [(device, numbers)] for the disk lines of an iostat block, where numbers is the rest of the line, unparsed.
+    :param device_pattern: compiled regex - only devices whose names match it are returned
+    """
+    if device_pattern is None:
+        return block.devices
+    return [(device, numbers) for device, numbers in block.devices if device_pattern.match(device)]
+
+
+def parse_columns(blocks, iostat_timezone, device_pattern=None):
+    """
+    Parse iostat blocks (as from parse_iostat()) into arrays, converting all of their numbers in one go.
+
+    Consecutive blocks with the same columns and devices are parsed together, yielding
+    (timestamps, devices, cpu, disks, cpu_fields, disk_fields) for each run of them - timestamps are in nanoseconds,
+    cpu is a (timestamps x CPU fields) array, and disks is a (timestamps x devices x disk fields) array. Devices
+    filtered out by device_pattern are dropped before any of their numbers are converted. Raises ValueError if any
+    block is malformed.
+    """
+    parsed = [(block.timestamp, block.cpu_fields if block.cpu is not None else (), block.cpu, block.disk_fields,
+               device_lines(block, device_pattern)) for block in blocks]
+    key = lambda item: (item[1], item[3], tuple(device for device, numbers in item[4]))
+    for (cpu_fields, disk_fields, devices), run in groupby(parsed, key=key):
+        run = list(run)
+        timestamps = [timestamp_to_ns(iostat_timezone.localize(item[0])) for item in run]
+        cpu = numpy.array(' '.join(item[2] for item in run if item[2] is not None).split(), dtype=numpy.float64)
+        disks = numpy.array(' '.join(numbers for item in run for device, numbers in item[4]).split(),
+                            dtype=numpy.float64)
+        if cpu.size != len(run) * len(cpu_fields) or disks.size != len(run) * len(devices) * len(disk_fields):
+            raise ValueError("Blocks have the wrong number of columns")
+        yield (timestamps, devices, cpu.reshape(len(run), len(cpu_fields)),
+               disks.reshape(len(run), len(devices), len(disk_fields)), cpu_fields, disk_fields)
+
+
+def column_values(timestamps, devices, cpu, disks, cpu_fields, disk_fields):
+    """Yield (timestamp, values, tags) for each point in the arrays from parse_columns(), like block_values()."""
+    for timestamp, cpu_values, device_values in zip(timestamps, cpu.tolist(), disks.tolist()):
+        if cpu_fields:
+            yield timestamp, dict(zip(cpu_fields, cpu_values)), None
+        for device, values in zip(devices, device_values):
+            yield timestamp, dict(zip(disk_fields, values)), {"device": device}
+
+
+class ColumnEncoder:
+    """
+    Encodes the arrays from parse_columns() to line protocol, as parse_iostat's LineEncoder would.
+
+    The field keys (for each set of columns) and each device's tags are escaped once, rather than for every point,
+    and the values come out of the arrays as Python floats in one tolist() call per run.
+    """
+    def __init__(self, encoder):
+        """
+        :param encoder: the LineEncoder for the measurement - its prefix (measurement and static tags) is reused
+        """
+        self.encoder = encoder
+        self._device_prefixes = {}
+        # field names: escaped keys
+        self._keys = {}
+
+    def _field_keys(self, fields):
+        keys = self._keys.get(fields)
+        if keys is None:
+            keys = self._keys[fields] = [escape_key(field) + '=' for field in fields]
+        return keys
+
+    def _device_prefix(self, device):
+        prefix = self._device_prefixes.get(device)
+        if prefix is None:
+            prefix = self._device_prefixes[device] = self.encoder.prefix + format_tags({"device": device}) + ' '
+        return prefix
+
+    def _fields(self, keys, values):
+        return ','.join([key + repr(value) for key, value in zip(keys, values)])
+
+    def encode(self, timestamps, devices, cpu, disks, cpu_fields, disk_fields):
+        """Return a list of lines - the CPU point, then one per device, for each timestamp."""
+        if not (numpy.isfinite(cpu).all() and numpy.isfinite(disks).all()) or (devices and not disk_fields):
+            # NaN and infinity can't be written, and are dropped field by field by the LineEncoder
+            return self._encode_slowly(timestamps, devices, cpu, disks, cpu_fields, disk_fields)
+        cpu_prefix = self.encoder.prefix + ' '
+        cpu_keys = self._field_keys(cpu_fields)
+        disk_keys = self._field_keys(disk_fields)
+        device_prefixes = [self._device_prefix(device) for device in devices]
+        lines = []
+        for timestamp, cpu_values, device_values in zip(timestamps, cpu.tolist(), disks.tolist()):
+            suffix = ' {}'.format(timestamp)
+            if cpu_keys:
+                lines.append((cpu_prefix + self._fields(cpu_keys, cpu_values) + suffix).encode('utf-8'))
+            for prefix, values in zip(device_prefixes, device_values):
+                lines.append((prefix + self._fields(disk_keys, values) + suffix).encode('utf-8'))
+        return lines
+
+    def _encode_slowly(self, timestamps, devices, cpu, disks, cpu_fields, disk_fields):
+        lines = []
+        for timestamp, cpu_values, device_values in zip(timestamps, cpu.tolist(), disks.tolist()):
+            lines.append(self.encoder.encode(timestamp, dict(zip(cpu_fields, cpu_values))))
+            for device, values in zip(devices, device_values):
+                lines.append(self.encoder.encode(timestamp, dict(zip(disk_fields, values)), {"device": device}))
+        return [line for line in lines if line]
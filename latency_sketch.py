@@ -0,0 +1,132 @@
+import math
+
+__author__ = 'victorhooi'
+
+# Relative accuracy of the percentiles - each one is within 1% of a duration that was actually seen
+_ACCURACY = 0.01
+_GAMMA = (1 + _ACCURACY) / (1 - _ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+PERCENTILES = [50, 95, 99]
+
+
+class LatencySketch:
+    """
+    A histogram of durations with logarithmically sized buckets (as in DDSketch, or HDR histograms), which gives
+    percentiles to within 1% using a few hundred counters at most, however many durations are added.
+
+    Two sketches are merged by adding their bucket counts, which gives exactly the sketch of all of their durations
+    together - so sketches built in separate worker processes can be combined without losing accuracy.
+    """
+    __slots__ = ('buckets', 'zeros', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, duration):
+        if duration <= 0:
+            self.zeros += 1
+        else:
+            index = math.ceil(math.log(duration) / _LOG_GAMMA)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, percentile):
+        """The duration below which percentile% of durations fall."""
+        rank = percentile / 100 * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                # The middle of the bucket, keeping the value within the range we've seen
+                value = 2 * _GAMMA ** index / (_GAMMA + 1)
+                return float(min(max(value, self.min), self.max))
+        return float(self.max)
+
+    def values(self):
+        """Fields for a point summarising the sketch."""
+        values = {'count': self.count, 'min': float(self.min), 'max': float(self.max), 'mean': self.total / self.count}
+        for percentile in PERCENTILES:
+            values['p{}'.format(percentile)] = self.percentile(percentile)
+        return values
+
+
+class LatencyAggregator:
+    """
+    A LatencySketch for each (time bucket, namespace, operation, plan summary) of slow operations.
+
+    Logs are in time order (give or take a little), so a bucket is finished once we've seen operations from two
+    buckets later, and only the last couple of buckets are held in memory.
+    """
+    def __init__(self, window):
+        """
+        :param window: bucket length in nanoseconds
+        """
+        self.window = window
+        # (bucket start, namespace, operation, plan_summary): LatencySketch
+        self.sketches = {}
+        self._latest = None
+
+    def add(self, timestamp, values, tags):
+        """Add a slow operation, as (timestamp, values, tags) from parse_operation()."""
+        start = timestamp - timestamp % self.window
+        key = (start, tags.get('namespace'), tags.get('operation'), tags.get('plan_summary'))
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = LatencySketch()
+        sketch.add(values['duration_in_milliseconds'])
+        if self._latest is None or start > self._latest:
+            self._latest = start
+
+    def merge(self, sketches):
+        """Merge in the sketches of another aggregator - e.g. one from a worker process."""
+        for key, sketch in sketches.items():
+            existing = self.sketches.get(key)
+            if existing is None:
+                self.sketches[key] = sketch
+            else:
+                existing.merge(sketch)
+            if self._latest is None or key[0] > self._latest:
+                self._latest = key[0]
+
+    def finished(self):
+        """Remove and return the buckets that are finished, as (timestamp, values, tags) points."""
+        if self._latest is None:
+            return []
+        return self._take([key for key in self.sketches if key[0] < self._latest - self.window])
+
+    def flush(self):
+        """Remove and return every bucket - at the end of the input."""
+        return self._take(list(self.sketches))
+
+    def _take(self, keys):
+        points = []
+        for key in sorted(keys, key=lambda key: tuple('' if part is None else part for part in key)):
+            start, namespace, operation, plan_summary = key
+            sketch = self.sketches.pop(key)
+            points.append((start, sketch.values(),
+                           {'namespace': namespace, 'operation': operation, 'plan_summary': plan_summary}))
+        return points
@@ -0,0 +1,134 @@
+from datetime import datetime, timezone
+from math import isfinite
+import re
+from dateutil.parser import parse
+
+__author__ = 'victorhooi'
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+_MEASUREMENT_ESCAPES = str.maketrans({',': r'\,', ' ': r'\ '})
+_KEY_ESCAPES = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ '})
+
+# For lines with escapes or string fields in them - series key, field set and timestamp, split on unescaped spaces
+# (outside of strings), then the key=value pairs of each
+_LINE = re.compile(r'((?:[^\\ ]|\\.)+) ((?:"(?:[^"\\]|\\.)*"|[^\\ "]|\\.)+)(?: (-?\d+))?$')
+_MEASUREMENT = re.compile(r'(?:[^\\,]|\\.)+')
+_TAG = re.compile(r',((?:[^\\=,]|\\.)+)=((?:[^\\,]|\\.)*)')
+_FIELD = re.compile(r'((?:[^\\=,]|\\.)+)=("(?:[^"\\]|\\.)*"|[^,]*)')
+_UNESCAPE = re.compile(r'\\(.)')
+
+
+def escape_measurement(name):
+    return name.translate(_MEASUREMENT_ESCAPES)
+
+
+def escape_key(key):
+    """Escape a tag key, tag value or field key."""
+    return key.translate(_KEY_ESCAPES)
+
+
+def format_field_value(value):
+    """
+    Format a field value the same way influxdb-python does, so that series written by either path have the same
+    field types - ints are written as integers ('i' suffix), everything else numeric as a float.
+    Returns None for values that can't be stored (NaN/infinity).
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value) if isfinite(value) else None
+    return '"{}"'.format(str(value).replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def timestamp_to_ns(timestamp):
+    """Convert an int (already in nanoseconds), ISO8601 string or datetime to nanoseconds since the epoch."""
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, str):
+        timestamp = parse(timestamp)
+    if timestamp.tzinfo is None:
+        # Naive datetimes are treated as UTC, matching influxdb-python
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    delta = timestamp - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
+
+def format_tags(tags):
+    return ''.join(',{}={}'.format(escape_key(key), escape_key(str(value)))
+                   for key, value in tags.items() if value is not None and value != '')
+
+
+class LineEncoder:
+    """
+    Encodes points for a single measurement straight to InfluxDB line protocol.
+
+    The measurement name and the static tags (project, hostname etc.) are escaped once, when the encoder is created,
+    rather than once per point. So are field keys, the first time each one is seen - a measurement only has a
+    handful of them (a few hundred for serverStatus).
+    """
+    def __init__(self, measurement, static_tags):
+        self.prefix = escape_measurement(measurement) + format_tags(static_tags)
+        self._field_keys = {}
+
+    def encode(self, timestamp, fields, tags=None):
+        """
+        Return a line protocol line (as bytes) for a single point, or None if there are no fields to write.
+        :param timestamp: int nanoseconds, ISO8601 string or datetime
+        :param fields: dict of field name to value
+        :param tags: dict of per-point tags, added to the static tags
+        """
+        field_set = []
+        field_keys = self._field_keys
+        for key, value in fields.items():
+            formatted = format_field_value(value)
+            if formatted is not None:
+                escaped = field_keys.get(key)
+                if escaped is None:
+                    escaped = field_keys[key] = escape_key(key) + '='
+                field_set.append(escaped + formatted)
+        if not field_set:
+            return None
+        line = '{}{} {} {}'.format(self.prefix, format_tags(tags) if tags else '', ','.join(field_set),
+                                   timestamp_to_ns(timestamp))
+        return line.encode('utf-8')
+
+
+def parse_field_value(value):
+    """The inverse of format_field_value()."""
+    if value.startswith('"'):
+        return _UNESCAPE.sub(r'\1', value[1:-1])
+    if value.endswith('i'):
+        return int(value[:-1])
+    if value in ('true', 't', 'T', 'True', 'TRUE'):
+        return True
+    if value in ('false', 'f', 'F', 'False', 'FALSE'):
+        return False
+    return float(value)
+
+
+def parse_line(line):
+    """
+    Split a line protocol line (bytes or str) back into (measurement, tags, fields, timestamp in nanoseconds).
+    The timestamp is None if the line doesn't have one.
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    if '\\' not in line and '"' not in line:
+        # Nothing escaped - which is nearly every line we write
+        parts = line.split(' ')
+        series = parts[0].split(',')
+        tags = dict(tag.split('=', 1) for tag in series[1:])
+        fields = {key: parse_field_value(value) for key, value in (field.split('=', 1) for field in parts[1].split(','))}
+        return series[0], tags, fields, int(parts[2]) if len(parts) > 2 else None
+    match = _LINE.match(line)
+    if match is None:
+        raise ValueError("Not a line protocol line - {}".format(line))
+    series, field_set, timestamp = match.groups()
+    measurement = _MEASUREMENT.match(series).group()
+    tags = {_UNESCAPE.sub(r'\1', key): _UNESCAPE.sub(r'\1', value)
+            for key, value in _TAG.findall(series, len(measurement))}
+    fields = {_UNESCAPE.sub(r'\1', key): parse_field_value(value) for key, value in _FIELD.findall(field_set)}
+    return _UNESCAPE.sub(r'\1', measurement), tags, fields, int(timestamp) if timestamp is not None else None
@@ -0,0 +1,124 @@
+__author__ = 'victorhooi'
+
+_MISSING = object()
+
+# Keys of the dicts that numbers too big (or too precise) for JSON are wrapped in, by the mongo shell and mongoexport
+_NUMBER_WRAPPERS = ('floatApprox', '$numberLong', '$numberInt', '$numberDouble', '$numberDecimal')
+
+
+def unwrap_number(field):
+    """
+    Strip the wrapping dict around a value, if it exists - e.g. {"floatApprox": 1} or {"$numberLong": "1"}.
+    """
+    if isinstance(field, dict):
+        for key in _NUMBER_WRAPPERS:
+            if key in field:
+                return field[key]
+        raise KeyError("Not a number - {}".format(field))
+    return field
+
+
+def numeric_paths(document, path=()):
+    """Yield the path (a tuple of keys) of every number in a document, including wrapped ones (see unwrap_number)."""
+    for key, value in document.items():
+        if isinstance(value, dict):
+            if any(wrapper in value for wrapper in _NUMBER_WRAPPERS):
+                yield path + (key,)
+            else:
+                yield from numeric_paths(value, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield path + (key,)
+
+
+class _Node:
+    """A level of the serverStatus document, with the metrics read at this level and the sub-documents below it."""
+    __slots__ = ('path', 'leaves', 'children')
+
+    def __init__(self, path):
+        self.path = path
+        # (key, measurement_name, metric_name) for each metric at this level
+        self.leaves = []
+        # (key, _Node) for each sub-document containing metrics
+        self.children = []
+
+    def child(self, key):
+        for child_key, node in self.children:
+            if child_key == key:
+                return node
+        node = _Node(self.path + (key,))
+        self.children.append((key, node))
+        return node
+
+
+class MetricPlan:
+    """
+    A set of metric definitions (see serverstatus_metrics.py) compiled into a prefix tree.
+
+    Metrics sharing a prefix such as ['wiredTiger', 'log', ...] are grouped under the same node, so each
+    serverStatus document is walked once, and every metric - for every measurement - is read in that single pass.
+    A missing sub-document (e.g. no wiredTiger section on MMAPv1) is skipped in one step, however many metrics
+    live beneath it.
+    """
+    def __init__(self, measurements):
+        """
+        :param measurements: dict of measurement name to metric definitions, e.g. {"serverstatus": common_metrics}
+        """
+        self.measurements = list(measurements)
+        self.root = _Node(())
+        for measurement_name, metrics in measurements.items():
+            for metric_name, location in metrics.items():
+                node = self.root
+                for key in location[:-1]:
+                    node = node.child(key)
+                node.leaves.append((location[-1], measurement_name, metric_name))
+
+    def extract(self, document):
+        """
+        Read every metric in the plan from a serverStatus document.
+        Returns ({measurement_name: {metric_name: value}}, [paths that were missing from the document]).
+        """
+        values = {measurement_name: {} for measurement_name in self.measurements}
+        missing = []
+        self._walk(self.root, document, values, missing)
+        return values, missing
+
+    def _walk(self, node, document, values, missing):
+        for key, measurement_name, metric_name in node.leaves:
+            value = document.get(key, _MISSING)
+            if value is _MISSING:
+                missing.append(node.path + (key,))
+                continue
+            try:
+                values[measurement_name][metric_name] = float(unwrap_number(value))  # Should this always be a float?
+            except (KeyError, TypeError, ValueError):
+                missing.append(node.path + (key,))
+        for key, child in node.children:
+            sub_document = document.get(key)
+            if isinstance(sub_document, dict):
+                self._walk(child, sub_document, values, missing)
+            else:
+                missing.append(child.path)
+
+
+class PlanCache:
+    """
+    MetricPlans for each kind of document, so the metrics for a kind are worked out once rather than per document.
+
+    Documents are told apart by fingerprint(document) - something cheap to compute, like the version and top-level
+    keys, that changes when the metrics in them do. The first document of each kind is passed to
+    build_plan(document), which returns the MetricPlan for that kind.
+    """
+    def __init__(self, fingerprint, build_plan):
+        self.fingerprint = fingerprint
+        self.build_plan = build_plan
+        self._plans = {}
+
+    def __len__(self):
+        return len(self._plans)
+
+    def plan_for(self, document):
+        key = self.fingerprint(document)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self.build_plan(document)
+        return plan
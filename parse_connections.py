@@ -1,21 +1,23 @@
 #!/usr/bin/env python3
-from influxdb import InfluxDBClient
 import argparse
-from dateutil.parser import parse
-from utils import grouper, configure_logging, write_points
+import sys
+from pytz import timezone
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from line_protocol import LineEncoder
+from timestamps import TimestampParser
+from inputs import add_follow_arguments, batches, open_lines
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from time_window import add_time_window_arguments, ctime_years, log_time, window_for_args
+from connection_table import ConnectionTable
+from cardinality import TagGuard, add_cardinality_arguments
 
 __author__ = 'victorhooi'
 
 
-def create_generic_point(name, value, timestamp, tags):
-    return {
-        "measurement": name,
-        "tags": tags,
-        "time": timestamp,
-        "fields": {
-            "value": float(value)
-        }
-    }
+def add_connection_arguments(parser):
+    parser.add_argument('--connection-ttl', default=86400, type=int, help='Forget about connections that have been open for longer than this many seconds (0 to never forget). Defaults to 86400 (a day).')
 
 
 parser = argparse.ArgumentParser(description='Parse serverStatus() output, and load it into an InfluxDB instance')
@@ -23,21 +25,18 @@ parser.add_argument('-b', '--batch-size', default=500, type=int, help="Batch siz
 parser.add_argument('-d', '--database', default="insight", help="Name of InfluxDB database to write to. Defaults to 'insight'.")
 parser.add_argument('-n', '--hostname', required=True, help='Host(Name) of the server')
 parser.add_argument('-p', '--project', required=True, help='Project name to tag this with')
+parser.add_argument('-t', '--timezone', default='UTC', help='Timezone of the source system for 2.4 loglines - e.g. "UTC", "US/Eastern", or "US/Pacific". Defaults to UTC.')
 parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
 parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+add_connection_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <input_file>.deadletter.')
+add_cardinality_arguments(parser)
+add_follow_arguments(parser)
+add_checkpoint_arguments(parser)
+add_time_window_arguments(parser)
 parser.add_argument('input_file')
-args = parser.parse_args()
-
-client = InfluxDBClient(host=args.influxdb_host, ssl=args.ssl, verify_ssl=False, port=8086, database=args.database)
-
-connections = {}
-connection_counters = []
-connection_events = []
-
-base_tags = {
-    'project': args.project,
-    'hostname': args.hostname,
-}
 
 
 class ConnectionEvent:
@@ -54,45 +53,39 @@ class ConnectionEvent:
 
     def get_tags(self):
         tags = {
-                'project': args.project,
-                'hostname': args.hostname,
                 'connection_id': self.connection_id,
                 'socket_address': self.socket_address,
                 'event_type': self.event_type,
         }
         return tags
 
-    def get_json(self):
-        return {
-            "measurement": "connection_events",
-            "tags": self.get_tags(),
-            "time": self.timestamp,
-            "fields": self.fields # What should we be storing, if duration doesn't exist?
-    }
+    def get_line(self, encoder, guard):
+        # What should we be storing, if duration doesn't exist?
+        fields, tags = guard.apply('connection_events', self.fields, self.get_tags())
+        return encoder.encode(self.timestamp, fields, tags)
 
 
 class OpenConnectionEvent(ConnectionEvent):
-    def __init__(self, timestamp, logline):
+    def __init__(self, timestamp, logline, connections):
         super(OpenConnectionEvent, self).__init__(timestamp, logline)
         self.connection_id = logline.split("#")[1].split()[0]  # Should this be a tag?
         self.socket_address = logline.split("accepted from ")[1].split()[0]  # Should this be a tag?
         self.event_type = 'open_connection'
-        connections[self.connection_id] = {'start_time': parse(timestamp)}
+        connections.open(int(self.connection_id), timestamp)
         self.fields = {"value": float(0)}
 
 class CloseConnectionEvent(ConnectionEvent):
-    def __init__(self, timestamp, logline):
+    def __init__(self, timestamp, logline, connections):
         super(CloseConnectionEvent, self).__init__(timestamp, logline)
         self.connection_id = logline.split("[conn")[1].split("]")[0]  # Should this be a tag?
         self.socket_address = logline.split("end connection ")[1].split()[0]  # Should this be a tag?
         self.event_type = 'close_connection'
-        if self.connection_id in connections:
-            connections[self.connection_id]['end_time'] = parse(timestamp)
-            self.duration = connections[self.connection_id]['end_time'] - connections[self.connection_id]['start_time']
+        start_time = connections.close(int(self.connection_id), timestamp)
+        if start_time is not None:
+            self.duration = timestamp - start_time
             self.matching_connection_open = True
-            self.fields = {"value": float(self.duration.total_seconds())}
+            self.fields = {"value": self.duration / 1e9}
         else:
-            connections[self.connection_id] = {'end_time': parse(timestamp)}
             self.matching_connection_open = False
             self.fields = {"value": float(0)}
 
@@ -101,49 +94,95 @@ class CloseConnectionEvent(ConnectionEvent):
         tags['matching_connection_open'] = self.matching_connection_open
         return tags
 
-logger = configure_logging('parse_connections')
-
-with open(args.input_file, 'r') as f:
-    line_counter = 0
-    for chunk in grouper(f, args.batch_size):
-        json_points = []
-        for line in chunk:
-            line_counter += 1
-            # zip_longest will backfill any missing values with None, so we need to handle this, otherwise we'll miss the last batch
-            # TODO - Properly handle loglines split over multiple lines, or lines containing just "\n"
-            if line:
-                # TODO This will work for 3.0 loglines only, which print out ISO8601 time - need to add in parsing 2.4/2.6 loglines
-                # Should we be parsing the timestamp into a datetime object, and localising?
-                try:
-                    timestamp, logline = line.split(maxsplit=1)
-                except ValueError as e:
-                    logger.error("Error parsing line - {} - {}".format(e, line))
-                    break
-                if ' connections now open)' in line:
-                    connection_count = line.split("(")[1].split()[0]
-                    # TODO - We should be sending an int, not a float - connection counters are integral values
-                    json_points.append(create_generic_point('connection_counters', connection_count, timestamp, base_tags))
-                if '[initandlisten] connection accepted from' in line:
-                    event = OpenConnectionEvent(timestamp, logline)
-                    json_points.append(event.get_json())
-                elif '] end connection ' in line:
-                    event = CloseConnectionEvent(timestamp, logline)
-                    json_points.append(event.get_json())
-        if json_points:
-            # We need to deal with 500: timeout - some kind of retry behaviour
-            # TODO - We shouldn't need to wrap this in try/except - should be handled by retry decorator
+
+class ConnectionHandler:
+    """
+    Turns connection open and close lines into connection_events points (with how long each connection was open),
+    and the "(n connections now open)" on them into connection_counters. It has the same interface as the other
+    handlers for ingest_log.py - see parse_operations.OperationHandler.
+    """
+    def __init__(self, project, hostname, connections, timestamps, logger, guard):
+        base_tags = {
+            'project': project,
+            'hostname': hostname,
+        }
+        self.event_encoder = LineEncoder('connection_events', base_tags)
+        self.counter_encoder = LineEncoder('connection_counters', base_tags)
+        self.connections = connections
+        self.timestamps = timestamps
+        self.logger = logger
+        self.guard = guard
+
+    @classmethod
+    def for_args(cls, parser, args, timestamps, logger, guard):
+        # Timestamps are in nanoseconds
+        connections = ConnectionTable(ttl=args.connection_ttl * 1000000000 if args.connection_ttl else None)
+        return cls(args.project, args.hostname, connections, timestamps, logger, guard)
+
+    def wants(self, line):
+        return ' connections now open)' in line or ' connection accepted from' in line or '] end connection ' in line
+
+    def handle(self, line):
+        points = []
+        # TODO - Properly handle loglines split over multiple lines, or lines containing just "\n"
+        if line.strip():
             try:
-                write_points(logger, client, json_points, line_counter)
-            except Exception as e:
-                logger.error("Retries exceeded. Giving up on this point.")
-        else:
-            print("empty points!!!")
-
-print("Number of connections: {}".format(len(connections)))
-i = 0
-for connection in connections.items():
-    if i < 10:
-        print(connection)
-        i += 1
-    else:
-        break
\ No newline at end of file
+                timestamp, logline = self.timestamps.split(line)
+            except ValueError as e:
+                self.logger.error("Error parsing line - {} - {}".format(e, line))
+                return points
+            if ' connections now open)' in line:
+                connection_count = line.split("(")[1].split()[0]
+                # TODO - We should be sending an int, not a float - connection counters are integral values
+                points.append(self.counter_encoder.encode(timestamp, {"value": float(connection_count)}))
+                self.guard.count('connection_counters', None)
+            if '[initandlisten] connection accepted from' in line:
+                event = OpenConnectionEvent(timestamp, logline, self.connections)
+                points.append(event.get_line(self.event_encoder, self.guard))
+            elif '] end connection ' in line:
+                event = CloseConnectionEvent(timestamp, logline, self.connections)
+                points.append(event.get_line(self.event_encoder, self.guard))
+        return points
+
+    def finished(self):
+        return []
+
+    def flush(self):
+        return []
+
+    def report(self):
+        print(self.connections.summary())
+
+
+def main():
+    args = parser.parse_args()
+    client_factory = sink_factory(parser, args)
+    logger = configure_logging('parse_connections')
+    guard = TagGuard.for_args(args, logger)
+    since, until = window_for_args(parser, args, log_time(args.input_file, timezone(args.timezone)), logger)
+    checkpoint = Checkpoint.for_args(args, logger)
+    start, line_counter = (checkpoint.offset, checkpoint.line_number) if checkpoint and checkpoint.offset > since \
+        else (since, 0)
+    timestamps = TimestampParser(tz=timezone(args.timezone), year=ctime_years(args.input_file, [0, start])[-1])
+    handler = ConnectionHandler.for_args(parser, args, timestamps, logger, guard)
+
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                         dead_letter_file=args.dead_letter or args.input_file + '.deadletter',
+                         on_durable=checkpoint.save if checkpoint else None) as writer:
+        for batch in batches(open_lines(args, start, until), args.batch_size, args.max_latency / 1000):
+            points = []
+            for line, offset in batch:
+                line_counter += 1
+                # Most lines aren't about connections - skip them before their timestamp is parsed
+                if handler.wants(line):
+                    points.extend(handler.handle(line))
+            end = batch[-1][1]
+            writer.write(points, line_counter, (start, end, line_counter))
+            start = end
+
+    handler.report()
+    logger.info("Series written - {}".format(guard.summary()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,44 +1,147 @@
 #!/usr/bin/env python3
 from datetime import datetime
-from influxdb import InfluxDBClient
 from pytz import timezone
 import urllib3
 import argparse
 import re
 import sys
-from utils import grouper, configure_logging, write_points
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from line_protocol import LineEncoder, timestamp_to_ns
+from inputs import add_follow_arguments, batches, open_input, open_lines
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from iostat_columns import ColumnEncoder, column_values, numpy, parse_columns
+from rollups import add_rollup_arguments, rollups_for_args
 
 
 urllib3.disable_warnings()
 
-system_stat_headers = ['user_cpu', 'nice_cpu', 'system_cpu', 'iowait', 'steal', 'idle']
-disk_stat_headers = ['read_requests_merged', 'write_requests_merged', 'read_requests', 'write_requests', 'read_sectors', 'write_sectors', 'average_request_size', 'average_queue_length', 'average_wait', 'average_service_time', 'utilisation']
+# Field names for the columns of the avg-cpu: and Device: lines, by their headings. Columns we don't know (from newer
+# versions of sysstat) are loaded too, under a name made from the heading - see field_name().
+cpu_fields = {'%user': 'user_cpu', '%nice': 'nice_cpu', '%system': 'system_cpu', '%iowait': 'iowait',
+              '%steal': 'steal', '%idle': 'idle'}
+disk_fields = {
+    # sysstat 10 and before
+    'rrqm/s': 'read_requests_merged', 'wrqm/s': 'write_requests_merged', 'r/s': 'read_requests',
+    'w/s': 'write_requests', 'rsec/s': 'read_sectors', 'wsec/s': 'write_sectors', 'avgrq-sz': 'average_request_size',
+    'avgqu-sz': 'average_queue_length', 'await': 'average_wait', 'r_await': 'read_wait', 'w_await': 'write_wait',
+    'svctm': 'average_service_time', '%util': 'utilisation',
+    # sysstat 11 and later (and iostat -k/-m)
+    'rkB/s': 'read_kilobytes', 'wkB/s': 'write_kilobytes', 'rMB/s': 'read_megabytes', 'wMB/s': 'write_megabytes',
+    '%rrqm': 'read_requests_merged_percent', '%wrqm': 'write_requests_merged_percent',
+    'aqu-sz': 'average_queue_length', 'rareq-sz': 'average_read_request_size',
+    'wareq-sz': 'average_write_request_size',
+    'd/s': 'discard_requests', 'dkB/s': 'discard_kilobytes', 'dMB/s': 'discard_megabytes',
+    'drqm/s': 'discard_requests_merged', '%drqm': 'discard_requests_merged_percent', 'd_await': 'discard_wait',
+    'dareq-sz': 'average_discard_request_size', 'f/s': 'flush_requests', 'f_await': 'flush_wait',
+}
+# Fields we also take the 95th percentile of in rollups
+percentile_headers = ['average_wait', 'read_wait', 'write_wait', 'utilisation']
 
-# TODO: Parse header line
-# E.g.: Linux 2.6.32-358.56.1.el6.x86_64 (db.example.com) 	06/29/15 	_x86_64_	(24 CPU)
+# Formats of the timestamp line at the start of each sample (iostat -t), which depends on the locale. The first that
+# matches is used until one doesn't.
+_TIMESTAMP_FORMATS = ["%m/%d/%y %H:%M:%S", "%m/%d/%Y %I:%M:%S %p", "%m/%d/%Y %H:%M:%S", "%m/%d/%y %I:%M:%S %p"]
+_TIMESTAMP_START = re.compile(r'\d\d/\d\d/\d\d')
+
+# What parse_iostat() expects the next line to be
+_CPU_VALUES = 1
+_DEVICES = 2
+
+
+def field_name(heading, fields):
+    """The field name for a column heading - from fields if it's there, otherwise e.g. 'rq/s' becomes 'rq_per_second'."""
+    name = fields.get(heading)
+    if name is None:
+        name = re.sub(r'[^0-9a-z]+', '_', heading.lower().replace('%', 'percent_').replace('/s', '_per_second'))
+        name = name.strip('_')
+    return name
+
+
+class IostatBlock:
+    """
+    One iostat sample: its timestamp (naive, in the source system's timezone), the CPU numbers (unparsed, or None if
+    there were none), (device, unparsed numbers) for each disk, and the field names for their columns.
+    """
+    __slots__ = ('timestamp', 'cpu_fields', 'cpu', 'disk_fields', 'devices', 'line_count')
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        self.cpu_fields = ()
+        self.cpu = None
+        self.disk_fields = ()
+        self.devices = []
+        self.line_count = 1
+
+    def __repr__(self):
+        return "IostatBlock({}, cpu={!r}, devices={!r})".format(self.timestamp, self.cpu, self.devices)
+
+
+def _timestamp(line, timestamp_format):
+    """Return (timestamp, format) for a timestamp line - trying timestamp_format first - or (None, timestamp_format)."""
+    for candidate in [timestamp_format] + _TIMESTAMP_FORMATS if timestamp_format else _TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(line, candidate), candidate
+        except ValueError:
+            pass
+    return None, timestamp_format
 
 
 def parse_iostat(lines):
-    """Parse lines of iostat information, yielding iostat blocks.
+    """Parse lines of iostat information, yielding (block, offset) for each iostat block (an IostatBlock).
+
+    lines should be an iterable yielding (line, offset) tuples, as from inputs.open_lines(). The offset yielded with
+    each block is the byte offset just past its last line. None items (from follow mode) are passed straight through.
 
-    lines should be an iterable yielding separate lines of output
+    Each line is recognised by a cheap check of how it starts - only lines that look like a timestamp are parsed as
+    one, with the format that matched the last one. The field names for each heading line are worked out the first
+    time it's seen, and shared by every block after it.
     """
     block = None
-    for line in lines:
+    block_end = None
+    expecting = None
+    timestamp_format = None
+    # heading line: field names
+    headings = {}
+    for item in lines:
+        if item is None:
+            yield None
+            continue
+        line, offset = item
         line = line.strip()
-        try:
-            if ' AM' in line or ' PM' in line: # What happens if their device names have AM or PM?
-                tm = datetime.strptime(line, "%m/%d/%Y %I:%M:%S %p")
-            else:
-                tm = datetime.strptime(line, "%m/%d/%y %H:%M:%S")
-            if block: yield block
-            block = [tm]
-        except ValueError:
-            # It's not a new timestamp, so add it to the existing block
-            # We ignore the iostat startup lines (which deals with random restarts of iostat), as well as empty lines
-            if '_x86_64_' not in line:
-                block.append(line)
-    if block: yield block
+        timestamp = None
+        if not line:
+            expecting = None
+        elif expecting == _CPU_VALUES:
+            block.cpu = line
+            expecting = None
+        elif _TIMESTAMP_START.match(line):
+            timestamp, timestamp_format = _timestamp(line, timestamp_format)
+        if timestamp is not None:
+            if block is not None:
+                yield block, block_end
+            block = IostatBlock(timestamp)
+            expecting = None
+        elif block is not None:
+            block.line_count += 1
+            if line.startswith('avg-cpu:'):
+                fields = headings.get(line)
+                if fields is None:
+                    fields = headings[line] = tuple(field_name(heading, cpu_fields) for heading in line.split()[1:])
+                block.cpu_fields = fields
+                expecting = _CPU_VALUES
+            elif line.startswith('Device'):
+                fields = headings.get(line)
+                if fields is None:
+                    fields = headings[line] = tuple(field_name(heading, disk_fields) for heading in line.split()[1:])
+                block.disk_fields = fields
+                expecting = _DEVICES
+            elif expecting == _DEVICES:
+                parts = line.split(None, 1)
+                block.devices.append((parts[0], parts[1] if len(parts) > 1 else ''))
+            # Anything else - e.g. the "Linux ..." line, when iostat is restarted - is ignored
+        block_end = offset
+    if block: yield block, block_end
 
 
 parser = argparse.ArgumentParser(description='Parse iostat output, and load it into an InfluxDB instance')
@@ -49,83 +152,117 @@ parser.add_argument('-p', '--project', required=True, help='Project name to tag
 parser.add_argument('-t', '--timezone', required=True, help='Hostname of the source system -e.g. "UTC", "US/Eastern", or "US/Pacific"')
 parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
 parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <input_file>.deadletter.')
+parser.add_argument('--devices', help='Only load disks whose device names match this regex - e.g. "sd|nvme". Defaults to every disk.')
+parser.add_argument('--block-parser', default='auto', choices=['auto', 'numpy', 'python'], help="How to parse iostat blocks. 'numpy' converts a batch of blocks at a time into arrays, 'python' converts each value separately, 'auto' uses numpy if it's installed. Defaults to auto.")
+add_rollup_arguments(parser)
+add_follow_arguments(parser)
+add_checkpoint_arguments(parser)
 parser.add_argument('input_file')
-args = parser.parse_args()
+
+
+def line_values(fields, numbers):
+    """Return {field: value} for a line of numbers. Raises ValueError if there isn't one number per field."""
+    numbers = numbers.split()
+    if len(numbers) != len(fields):
+        raise ValueError("Expected {} columns, found {}".format(len(fields), len(numbers)))
+    return {field: float(number) for field, number in zip(fields, numbers)}
+
+
+def block_values(block, iostat_timezone, device_pattern=None):
+    """
+    Yield (timestamp, values, tags) for the CPU and each disk in an iostat block, as from parse_iostat().
+    Only disks whose names match device_pattern (a compiled regex) are included, if it's given.
+    Raises ValueError if the block is malformed.
+    """
+    timestamp = iostat_timezone.localize(block.timestamp)
+    if block.cpu is not None:
+        yield timestamp, line_values(block.cpu_fields, block.cpu), None
+    for device, numbers in block.devices:
+        if device_pattern and not device_pattern.match(device):
+            continue
+        yield timestamp, line_values(block.disk_fields, numbers), {"device": device}
+
+
+def load(parser, args, logger, start=0, line_counter=2):
+    """
+    Yield (points, line number, position) for each batch of iostat blocks in args.input_file, from the byte offset
+    start, then the last windows of any rollups (with no position). position is as for PointWriter.write().
+    """
+    if args.block_parser == 'numpy' and not numpy:
+        parser.error("NumPy is not installed")
+    columnar = numpy and args.block_parser != 'python'
+    device_pattern = re.compile(args.devices) if args.devices else None
+    rollups = rollups_for_args(parser, args, percentile_headers)
+    iostat_timezone = timezone(args.timezone)
+    with open_input(args.input_file) as f:
+        header = f.readline().decode('utf-8') # The "Linux..." line
+        f.readline() # Skip the blank line
+        header_end = f.tell()
+    if args.hostname:
+        hostname = args.hostname
+    else:
+        hostname = re.split(r'[()]', header)[1]
+    logger.info("Found hostname {}".format(hostname))
+    encoder = LineEncoder("iostat", {"project": args.project, "hostname": hostname})
+    column_encoder = ColumnEncoder(encoder)
+    rollup_encoders = [LineEncoder("iostat_" + rollup.label, {"project": args.project, "hostname": hostname}) for rollup in rollups]
+    start = max(start, header_end)
+    blocks = parse_iostat(open_lines(args, start))
+    for batch in batches(blocks, args.batch_size, args.max_latency / 1000):
+        iostat_blocks = [block for block, offset in batch if block]
+        line_counter += sum(block.line_count for block in iostat_blocks)
+        points = None
+        if columnar:
+            try:
+                points, records = [], []
+                for columns in parse_columns(iostat_blocks, iostat_timezone, device_pattern):
+                    if not args.rollup_only:
+                        points.extend(column_encoder.encode(*columns))
+                    if rollups:
+                        records.extend(column_values(*columns))
+            except (IndexError, ValueError):
+                # Go through the batch block by block, to find (and skip) the bad ones
+                points = None
+        if points is None:
+            points, records = [], []
+            for block in iostat_blocks:
+                try:
+                    for timestamp, values, tags in block_values(block, iostat_timezone, device_pattern):
+                        if not args.rollup_only:
+                            points.append(encoder.encode(timestamp, values, tags))
+                        if rollups:
+                            records.append((timestamp_to_ns(timestamp), values, tags))
+                except ValueError as e:
+                    print("Bad output seen - skipping")
+                    print(e)
+                    print(block)
+        for timestamp, values, tags in records:
+            for rollup, rollup_encoder in zip(rollups, rollup_encoders):
+                for rolled_up in rollup.add(timestamp, "iostat", values, tags):
+                    points.append(rollup_encoder.encode(rolled_up[0], rolled_up[2], rolled_up[3]))
+        end = batch[-1][1]
+        yield points, line_counter, (start, end, line_counter)
+        start = end
+    # The last window of each rollup
+    yield ([rollup_encoder.encode(timestamp, values, tags) for rollup, rollup_encoder in zip(rollups, rollup_encoders)
+            for timestamp, measurement_name, values, tags in rollup.flush()], line_counter, None)
 
 
 def main():
-    client = InfluxDBClient(host=args.influxdb_host, ssl=args.ssl, verify_ssl=False, port=8086, database=args.database)
+    args = parser.parse_args()
+    client_factory = sink_factory(parser, args)
     logger = configure_logging('parse_iostat')
-    iostat_timezone = timezone(args.timezone)
-    with open(args.input_file, 'r') as f:
-        if args.hostname:
-            f.__next__() # Skip the "Linux..." line
-        else:
-            hostname = re.split(r'[()]', f.readline())[1]
-        logger.info("Found hostname {}".format(hostname))
-        f.__next__() # Skip the blank line
-        line_counter = 2
-        for chunk_index, chunk in enumerate(grouper(parse_iostat(f), args.batch_size)):
-            json_points = []
-            for block in chunk:
-                if block:
-                    try:
-                        for i, line in enumerate(block):
-                            line_counter += 1
-                            if i == 0:
-                                timestamp = iostat_timezone.localize(line)
-                                # print(timestamp)
-                                # import ipdb;ipdb.set_trace()
-                                # print("timestamp is {}".format(timestamp))
-                                # TODO: Timezone?
-                                # TODO: Better way of storing timestamp
-                            elif i == 1: # CPU Metric Headings
-                                pass
-                            elif i==2:
-                                system_stats = dict(zip(system_stat_headers, line.split()))
-                                values = {}
-                                for metric_name, value in system_stats.items():
-                                    values[metric_name] = float(value)
-                                json_points.append({
-                                    "measurement": "iostat",
-                                    "tags": {
-                                        "project": args.project,
-                                        "hostname": hostname
-                                    },
-                                    "time": timestamp.isoformat(),
-                                    "fields": values
-                                })
-                            elif i==4: # Disk metric headings
-                                pass
-                            elif i >= 5 and line:
-                                disk_stats = {}
-                                device = line.split()[0]
-                                disk_stats[device] = dict(zip(disk_stat_headers, line.split()[1:]))
-
-                                for disk_name, metrics in disk_stats.items():
-                                    values = {}
-                                    for metric_name, value in metrics.items():
-                                        # Nasty hack to deal with bad data from Morgan Stanley
-                                        # if disk_name not in ['sda', 'sdb', 'dm-0', 'dm-1', 'dm-2']:
-                                        #     print(block)
-                                        #     raise ValueError
-                                        values[metric_name] = float(value)
-                                    json_points.append({
-                                        "measurement": "iostat",
-                                        "tags": {
-                                            "project": args.project,
-                                            "hostname": hostname,
-                                            "device": disk_name,
-                                        },
-                                        "time": timestamp.isoformat(),
-                                        "fields": values
-                                    })
-
-                    except ValueError as e:
-                        print("Bad output seen - skipping")
-                        print(e)
-                        print(block)
-            write_points(logger, client, json_points, line_counter)
+    checkpoint = Checkpoint.for_args(args, logger)
+    start, line_counter = (checkpoint.offset, checkpoint.line_number) if checkpoint and checkpoint.offset > 0 \
+        else (0, 2)
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter or args.input_file + '.deadletter',
+                     on_durable=checkpoint.save if checkpoint else None) as writer:
+        for points, line_counter, position in load(parser, args, logger, start, line_counter):
+            writer.write(points, line_counter, position)
 
 if __name__ == "__main__":
     sys.exit(main())
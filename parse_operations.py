@@ -1,25 +1,31 @@
 #!/usr/bin/env python3
-from influxdb import InfluxDBClient
 import json
 import argparse
+import os
+import re
 import sys
-from dateutil.parser import parse
-from utils import grouper, configure_logging, write_points
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pytz import timezone
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from line_protocol import LineEncoder
+from timestamps import TimestampParser
+from inputs import add_follow_arguments, batches, compression, open_lines, read_lines
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from time_window import add_time_window_arguments, ctime_years, log_time, window_for_args
+from latency_sketch import LatencyAggregator
+from cardinality import TagGuard, add_cardinality_arguments
+from query_shapes import QueryShapes
+from rollups import parse_window
 
 
 _MEASUREMENT_PREFIX = "operations_"
 
 __author__ = 'victorhooi'
 
-def create_point(timestamp, measurement_name, values, tags):
-    return {
-        "measurement": measurement_name,
-        "tags": tags,
-        "time": timestamp,
-        "fields": values
-    }
-
-
 # def create_point(timestamp, metric_name, value, tags):
 #     return {
 #         "measurement": _MEASUREMENT_PREFIX + metric_name,
@@ -31,87 +37,409 @@ def create_point(timestamp, measurement_name, values, tags):
 #     }
 
 
+def add_operation_arguments(parser):
+    parser.add_argument('--latency-window', metavar='WINDOW', help='Also write the count, mean and percentiles of operation durations per namespace, operation and plan summary over windows of this length (e.g. 1m), to operations_latency.')
+    parser.add_argument('--latency-only', action='store_true', default=False, help='Only write the latency percentiles, not a point per slow operation.')
+    parser.add_argument('--query-shapes', action='store_true', default=False, help='Also group slow operations by query shape (the query with its values taken out), and write the count, total, mean and max duration, documents examined per document returned and whether it used a COLLSCAN for each shape to operations_shapes at the end.')
+    parser.add_argument('--top-shapes', default=20, type=int, help='Number of query shapes to print, by total time spent, with --query-shapes. Defaults to 20.')
+
+
 parser = argparse.ArgumentParser(description='Parse a mongod.log logfile for query timing information, and load it into an InfluxDB instance')
 parser.add_argument('-b', '--batch-size', default=5000, type=int, help="Batch size to process before writing to InfluxDB.")
 parser.add_argument('-d', '--database', default="insight", help="Name of InfluxDB database to write to. Defaults to 'insight'.")
 parser.add_argument('-n', '--hostname', required=True, help='Host(Name) of the server')
 parser.add_argument('-p', '--project', required=True, help='Project name to tag this with')
-# Override or set for 2.4
-# parser.add_argument('-t', '--timezone', required=True, help='Hostname of the source system -e.g. "UTC", "US/Eastern", or "US/Pacific"')
+# 2.4 loglines are in the server's local time, without a UTC offset
+parser.add_argument('-t', '--timezone', default='UTC', help='Timezone of the source system for 2.4 loglines - e.g. "UTC", "US/Eastern", or "US/Pacific". Defaults to UTC.')
 parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
 parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <input_file>.deadletter.')
+parser.add_argument('--workers', default=1, type=int, help='Number of processes to parse the logfile with. Defaults to 1.')
+parser.add_argument('--shard-size', default=32, type=int, help='Size (in MB) of each piece of the logfile handed to a worker process. Defaults to 32.')
+add_operation_arguments(parser)
+add_cardinality_arguments(parser)
+add_follow_arguments(parser)
+add_checkpoint_arguments(parser)
+add_time_window_arguments(parser)
 parser.add_argument('input_file')
-args = parser.parse_args()
+
+_OPERATIONS = ['command', 'query', 'getmore', 'insert', 'update', 'remove', 'aggregate', 'mapreduce']
+
+
+# (resource, lock statistic, mode), as they appear in the line (give or take whitespace): field name
+# - e.g. ('Global', ' acquireCount', ' r'): 'locks_global_acquire_count_r'
+_lock_fields = {}
+
+
+def _lock_field(resource, statistic, mode):
+    # camelCase to snake_case, like the serverStatus metric names. Modes keep their case - r/w are intent locks, R/W
+    # are shared and exclusive.
+    field = _lock_fields[(resource, statistic, mode)] = 'locks_{}_{}_{}'.format(
+        re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', resource.strip()).lower(),
+        re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', statistic.strip()).lower(), mode.strip())
+    return field
+
+
+def _scan_locks(locks):
+    """
+    This isn't JSON, but it is always three levels deep (resource, statistic, mode), so it is scanned in a single
+    pass over the pieces between each "key: {": a piece without a closing brace is a statistic name, and a piece with
+    one holds a statistic's mode: count pairs, followed by the next statistic's name (after one closing brace and a
+    comma) or the next resource's (after two). Three closing braces are the end of "locks:{".
+    """
+    values = {}
+    pieces = locks.split(': {')
+    # Names are left as they are (with any surrounding whitespace) - they're only looked up in _lock_fields
+    resource = pieces[0]
+    statistic = None
+    for piece in pieces[1:]:
+        close = piece.find('}')
+        if close < 0:
+            statistic = piece
+            continue
+        for mode, _, count in (pair.partition(':') for pair in piece[:close].split(',')):
+            field = _lock_fields.get((resource, statistic, mode)) or _lock_field(resource, statistic, mode)
+            try:
+                values[field] = int(count)
+            except ValueError:
+                pass
+        # '}, <statistic>', '} }, <resource>' or '} } } <rest of the line>'
+        if piece[close + 1:close + 2] == ',':
+            statistic = piece[close + 2:]
+        elif piece[close + 3:close + 4] == ',':
+            resource = piece[close + 4:]
+        else:
+            break
+    return values
+
+
+# Lock sections we've already scanned: section text: fields. Cleared when it fills up.
+_lock_sections = {}
+_LOCK_SECTIONS_SIZE = 10000
+
+
+def parse_locks(locks, values=None):
+    """
+    Parse the lock statistics of a 3.x slow operation line - the text following "locks:{", e.g.
+    ' Global: { acquireCount: { r: 2 } }, Database: { acquireCount: { r: 1 }, timeAcquiringMicros: { r: 1204 } } } 105ms'
+    - into a dict of flattened fields, e.g. {'locks_global_acquire_count_r': 2, ...}, or into values if it's given.
+
+    Most operations take the same few locks the same number of times (only waits vary much), so the same sections
+    come up again and again - each one is only scanned the first time it is seen.
+    """
+    if values is None:
+        values = {}
+    end = locks.find('} } }')
+    if end < 0:
+        # Truncated, or empty
+        values.update(_scan_locks(locks))
+        return values
+    section = locks[:end]
+    fields = _lock_sections.get(section)
+    if fields is None:
+        if len(_lock_sections) >= _LOCK_SECTIONS_SIZE:
+            _lock_sections.clear()
+        fields = _lock_sections[section] = _scan_locks(locks)
+    values.update(fields)
+    return values
+
+
+def parse_operation(line, timestamps, logger):
+    """
+    Parse a single mongod.log line, using the TimestampParser for this file.
+    Returns a (timestamp, values, tags) tuple for slow operations, or None for any other line.
+    """
+    line = line.rstrip()
+    if not line.endswith("ms"):
+        return None
+    values = {}
+    tags = {}
+    try:
+        tags['operation'] = line.split("] ", 1)[1].split()[0]
+    except IndexError as e:
+        logger.error("Unable to parse line - {} - {}".format(e, line))
+        return None
+    if tags['operation'] not in _OPERATIONS:
+        return None
+    # print(line.strip())
+    thread = line.split("[", 1)[1].split("]")[0]
+    # Alternately - print(split_line[3])
+    if tags['operation'] == 'command':
+        tags['command'] = line.split("command: ")[1].split()[0]
+    if "conn" in thread:
+        tags['connection_id'] = thread
+    timestamp, rest = timestamps.split(line)
+    split_line = rest.split()
+    values['duration_in_milliseconds'] = int(split_line[-1].rstrip('ms'))
+    if split_line[0].startswith("["):
+        # 2.4/2.6 Logline:
+        tags['namespace'] = split_line[2]
+        for stat in reversed(split_line):
+            if "ms" in stat:
+                pass
+            elif ":" in stat:
+                key, value = stat.split(":", 1)
+                values[key] = int(value)
+            elif stat == "locks(micros)":
+                pass
+            else:
+                break
+    else:
+        # 3.x logline:
+        tags['namespace'] = split_line[4]
+        pre_locks, locks = line.split("locks:{", 1)
+        # We work backwards from the end, until we run out of key:value pairs
+        # TODO - Can we assume these are always integers?
+        for stat in reversed(pre_locks.split()):
+            if ":" in stat:
+                key, value = stat.split(":", 1)
+                values[key] = int(value)
+            else:
+                break
+        parse_locks(locks, values)
+        # TODO - Parse the full query plan for IXSCAN
+        if 'planSummary: ' in line:
+            tags['plan_summary'] = (line.split('planSummary: ', 1)[1].split()[0])
+    return timestamp, values, tags
+
+
+class OperationHandler:
+    """
+    Turns slow operation lines into points - one per operation (unless raw is False), plus latency percentiles and
+    query shapes, if they're on.
+
+    This is the slow operation handler for ingest_log.py too, so it has the same interface as the handlers for
+    other kinds of line: wants() is a cheap check of whether a line is one of ours, handle() returns the points for
+    a line, finished() the points that are complete at the end of a batch, and flush() the rest, at the end of the
+    input.
+    """
+    def __init__(self, encoder, timestamps, logger, latencies=None, raw=True, guard=None, shapes=None,
+                 latency_encoder=None, shapes_encoder=None, top_shapes=20):
+        """
+        :param latencies: LatencyAggregator to add each operation to
+        :param guard: TagGuard to rewrite each operation's tags with
+        :param shapes: QueryShapes to add each operation to
+        """
+        self.encoder = encoder
+        self.timestamps = timestamps
+        self.logger = logger
+        self.latencies = latencies
+        self.raw = raw
+        self.guard = guard
+        self.shapes = shapes
+        self.latency_encoder = latency_encoder
+        self.shapes_encoder = shapes_encoder
+        self.top_shapes = top_shapes
+
+    @classmethod
+    def for_args(cls, parser, args, timestamps, logger, guard):
+        """Return the OperationHandler for a parser's arguments, exiting with a usage message if they don't add up."""
+        if args.latency_only and not args.latency_window:
+            parser.error("--latency-only needs a --latency-window")
+        if args.query_shapes and args.follow:
+            # The shapes are written once the whole file has been read
+            parser.error("--query-shapes can't be used with --follow")
+        try:
+            latencies = LatencyAggregator(parse_window(args.latency_window)) if args.latency_window else None
+        except ValueError as e:
+            parser.error(str(e))
+        base_tags = {'project': args.project, 'hostname': args.hostname}
+        return cls(LineEncoder("operations", base_tags), timestamps, logger, latencies, not args.latency_only, guard,
+                   QueryShapes() if args.query_shapes else None, LineEncoder("operations_latency", base_tags),
+                   LineEncoder("operations_shapes", base_tags), args.top_shapes)
+
+    def wants(self, line):
+        return line.rstrip().endswith("ms")
+
+    def handle(self, line):
+        """
+        Return the point for a slow operation line (or none, if raw is False or it isn't one).
+        The operation is added to the QueryShapes, its tags are rewritten by the TagGuard, and it is then added to the
+        LatencyAggregator.
+        """
+        operation = parse_operation(line, self.timestamps, self.logger)
+        if not operation:
+            return []
+        if self.shapes is not None:
+            self.shapes.add(line, *operation)
+        if self.guard is not None:
+            timestamp, values, tags = operation
+            values, tags = self.guard.apply("operations", values, tags, count=self.raw)
+            operation = timestamp, values, tags
+        if self.latencies is not None:
+            self.latencies.add(*operation)
+        if self.raw:
+            point = self.encoder.encode(*operation)
+            if point:
+                return [point]
+        return []
+
+    def finished(self):
+        if self.latencies is None:
+            return []
+        return self.encode_aggregates(self.latency_encoder, "operations_latency", self.latencies.finished())
+
+    def flush(self):
+        points = []
+        if self.latencies is not None:
+            points.extend(self.encode_aggregates(self.latency_encoder, "operations_latency", self.latencies.flush()))
+        if self.shapes is not None:
+            points.extend(self.encode_aggregates(self.shapes_encoder, "operations_shapes", self.shapes.points()))
+        return points
+
+    def report(self):
+        if self.shapes is not None:
+            print("\n".join(self.shapes.report(self.top_shapes)))
+
+    def encode_aggregates(self, encoder, measurement_name, points):
+        """Encode the (timestamp, values, tags) points from a LatencyAggregator or QueryShapes."""
+        if self.guard is not None:
+            for timestamp, values, tags in points:
+                self.guard.count(measurement_name, tags)
+        return [encoder.encode(*point) for point in points]
+
+
+def parse_lines(lines, handler):
+    """Yield the encoded points for every slow operation in lines."""
+    for line in lines:
+        yield from handler.handle(line)
+
+
+def split_file(input_file, shard_size, start=0, end=None):
+    """
+    Split a file (between the byte offsets start and end) into (start, end) byte ranges of roughly shard_size bytes.
+    Every range starts at the beginning of a line and ends just after a newline (or at the end of the file).
+    """
+    size = os.path.getsize(input_file) if end is None else end
+    shards = []
+    with open(input_file, 'rb') as f:
+        while start < size:
+            f.seek(min(start + shard_size, size))
+            f.readline()
+            end = min(f.tell(), size)
+            shards.append((start, end))
+            start = end
+    return shards
+
+
+# State for the worker processes, set up once per process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(project, hostname, tz, latency_window, raw, tags_to_fields, strip_ports, query_shapes):
+    _worker_state['encoder'] = LineEncoder("operations", {'project': project, 'hostname': hostname})
+    _worker_state['tz'] = tz
+    _worker_state['logger'] = configure_logging('parse_operations')
+    _worker_state['latency_window'] = latency_window
+    _worker_state['raw'] = raw
+    _worker_state['tags_to_fields'] = tags_to_fields
+    _worker_state['strip_ports'] = strip_ports
+    _worker_state['query_shapes'] = query_shapes
+
+
+def _parse_shard(input_file, start, end, year):
+    """
+    Parse one byte range of the logfile in a worker process. year is the year 2.4 log lines are in at start (see
+    ctime_years()), which the worker can't tell from its own lines.
+    Returns (points, number of lines, end, latency sketches, series, query shapes) - the sketches, series and shapes
+    are merged by the parent process.
+    """
+    lines = [line for line, offset in read_lines(input_file, start, end)]
+    latencies = LatencyAggregator(_worker_state['latency_window']) if _worker_state['latency_window'] else None
+    guard = TagGuard(_worker_state['logger'], _worker_state['tags_to_fields'], _worker_state['strip_ports'])
+    shapes = QueryShapes() if _worker_state['query_shapes'] else None
+    handler = OperationHandler(_worker_state['encoder'], TimestampParser(tz=_worker_state['tz'], year=year),
+                               _worker_state['logger'], latencies, _worker_state['raw'], guard, shapes)
+    points = list(parse_lines(lines, handler))
+    return (points, len(lines), end, latencies.sketches if latencies else None, guard.series_counters(),
+            shapes.shapes if shapes else None)
+
+
+def parse_sharded(args, writer, handler, start, until, line_count):
+    """
+    Parse the logfile from the byte offset start to until (None for the end of the file) with a pool of worker
+    processes, one byte range at a time, merging their latency sketches, series and query shapes into handler's.
+    Results are handed to the writer in file order, so the points written are the same as a single process run.
+    Only a few shards per worker are in flight at once, which bounds memory use. Returns the number of lines read.
+    """
+    shards = split_file(args.input_file, args.shard_size * 1024 * 1024, start, until)
+    # The year 2.4 lines are in at the start of each shard, as parsing the file in one process would have it
+    years = ctime_years(args.input_file, [0] + [shard_start for shard_start, shard_end in shards])[1:]
+    shards = [shard + (year,) for shard, year in zip(shards, years)]
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(args.project, args.hostname, timezone(args.timezone),
+                                       handler.latencies.window if handler.latencies else None, handler.raw,
+                                       args.tag_to_field, args.strip_port, handler.shapes is not None)) as pool:
+        shards = iter(shards)
+        pending = deque(pool.submit(_parse_shard, args.input_file, *shard) for shard in islice(shards, args.workers * 2))
+        while pending:
+            points, lines, end, sketches, series, shapes = pending.popleft().result()
+            shard = next(shards, None)
+            if shard:
+                pending.append(pool.submit(_parse_shard, args.input_file, *shard))
+            line_count += lines
+            handler.guard.merge_series(series)
+            if handler.shapes:
+                handler.shapes.merge(shapes)
+            if handler.latencies:
+                handler.latencies.merge(sketches)
+            points.extend(handler.finished())
+            # Only the shard's last batch carries its position, so the checkpoint never lands part way through a shard
+            shard_batches = [points[i:i + args.batch_size] for i in range(0, len(points), args.batch_size)] or [[]]
+            for batch in shard_batches[:-1]:
+                writer.write(batch, line_count)
+            writer.write(shard_batches[-1], line_count, (start, end, line_count))
+            start = end
+    return line_count
+
+
+def parse_single(args, writer, handler, start, until, line_count):
+    """
+    Parse the logfile (or follow it) in this process, from the byte offset start to until (None for the end of the
+    file), with line numbers carrying on from line_count. Returns the number of lines read.
+    """
+    for batch in batches(open_lines(args, start, until), args.batch_size, args.max_latency / 1000):
+        line_count += len(batch)
+        end = batch[-1][1]
+        points = list(parse_lines((line for line, offset in batch), handler))
+        points.extend(handler.finished())
+        writer.write(points, line_count, (start, end, line_count))
+        start = end
+    return line_count
+
 
 def main():
-    client = InfluxDBClient(host=args.influxdb_host, ssl=args.ssl, verify_ssl=False, port=8086, database=args.database)
+    args = parser.parse_args()
+    client_factory = sink_factory(parser, args)
     logger = configure_logging('parse_operations')
-    with open(args.input_file, 'r') as f:
-        line_count = 0
-        for chunk in grouper(f, args.batch_size):
-            json_points = []
-            for line in chunk:
-                # zip_longest will backfill any missing values with None, so we need to handle this, otherwise we'll miss the last batch
-                line_count += 1
-                if line and line.endswith("ms"):
-                    values = {}
-                    tags = {
-                        'project': args.project,
-                        'hostname': args.hostname,
-                    }
-                    try:
-                        tags['operation'] = line.split("] ", 1)[1].split()[0]
-                    except IndexError as e:
-                        logger.error("Unable to parse line - {} - {}".format(e, line))
-                        break
-                    if tags['operation'] in ['command', 'query', 'getmore', 'insert', 'update', 'remove', 'aggregate', 'mapreduce']:
-                        # print(line.strip())
-                        thread = line.split("[", 1)[1].split("]")[0]
-                        # Alternately - print(split_line[3])
-                        if tags['operation'] == 'command':
-                            tags['command'] = line.split("command: ")[1].split()[0]
-                        if "conn" in thread:
-                            tags['connection_id'] = thread
-                        split_line = line.split()
-                        values['duration_in_milliseconds'] = int(split_line[-1].rstrip('ms'))
-                        # TODO 2.4.x timestamps have spaces
-                        timestamp = parse(split_line[0])
-                        if split_line[1].startswith("["):
-                            # 2.4 Logline:
-                            tags['namespace'] = split_line[3]
-                            for stat in reversed(split_line):
-                                if "ms" in stat:
-                                    pass
-                                elif ":" in stat:
-                                    key, value = stat.split(":", 1)
-                                    values[key] = int(value)
-                                elif stat == "locks(micros)":
-                                    pass
-                                else:
-                                    break
-                        else:
-                            # 3.x logline:
-                            tags['namespace'] = split_line[5]
-                            # TODO - Parse locks
-                            pre_locks, locks = line.split("locks:{", 1)
-                            # We work backwards from the end, until we run out of key:value pairs
-                            # TODO - Can we assume these are always integers?
-                            for stat in reversed(pre_locks.split()):
-                                if ":" in stat:
-                                    key, value = stat.split(":", 1)
-                                    values[key] = int(value)
-                                else:
-                                    break
-                            # TODO - Parse the full query plan for IXSCAN
-                            if 'planSummary: ' in line:
-                                tags['plan_summary'] = (line.split('planSummary: ', 1)[1].split()[0])
-                        json_points.append(create_point(timestamp, "operations", values, tags))
-            if json_points:
-                # TODO - We shouldn't need to wrap this in try/except - should be handled by retry decorator
-                try:
-                    write_points(logger, client, json_points, line_count)
-                except Exception as e:
-                    logger.error("Retries exceeded. Giving up on this point.")
+    if args.follow and args.workers > 1:
+        parser.error("--follow can't be used with --workers")
+    if args.workers > 1 and compression(args.input_file):
+        # Workers seek straight to their piece of the file, which compressed files can't do
+        parser.error("--workers can't be used with a compressed input file")
+    if args.max_tag_values is not None and args.workers > 1:
+        # Which values make the cut depends on the order they're seen in, so it can't be split between processes
+        parser.error("--max-tag-values can't be used with --workers")
+    guard = TagGuard.for_args(args, logger)
+    since, until = window_for_args(parser, args, log_time(args.input_file, timezone(args.timezone)), logger)
+    checkpoint = Checkpoint.for_args(args, logger)
+    start, line_count = (checkpoint.offset, checkpoint.line_number) if checkpoint and checkpoint.offset > since \
+        else (since, 0)
+    timestamps = TimestampParser(tz=timezone(args.timezone), year=ctime_years(args.input_file, [0, start])[-1])
+    handler = OperationHandler.for_args(parser, args, timestamps, logger, guard)
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter or args.input_file + '.deadletter',
+                     on_durable=checkpoint.save if checkpoint else None) as writer:
+        if args.workers > 1:
+            line_count = parse_sharded(args, writer, handler, start, until, line_count)
+        else:
+            line_count = parse_single(args, writer, handler, start, until, line_count)
+        writer.write(handler.flush(), line_count)
+    handler.report()
+    logger.info("Series written - {}".format(guard.summary()))
+
+
 if __name__ == "__main__":
     sys.exit(main())
-
@@ -1,72 +1,165 @@
 #!/usr/bin/env python3
-from influxdb import InfluxDBClient
-import json
 import argparse
+import re
 import sys
-from utils import get_nested_items, grouper, configure_logging, write_points
-from serverstatus_metrics import common_metrics, mmapv1_metrics, wiredtiger_metrics
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+from line_protocol import LineEncoder, timestamp_to_ns
+from timestamps import TimestampParser
+from counter_rates import CounterRates
+from rollups import add_rollup_arguments, rollups_for_args
+from metric_plan import MetricPlan, PlanCache, numeric_paths, unwrap_number
+from decoders import get_decoder
+from inputs import add_follow_arguments, batches, open_lines
+from checkpoint import Checkpoint, add_checkpoint_arguments
+from time_window import add_time_window_arguments, window_for_args
+from serverstatus_metrics import common_metrics, counter_metrics, mmapv1_metrics, wiredtiger_metrics
 
 
 _MEASUREMENT_PREFIX = "ss_"
+_RATES_SUFFIX = "_rates"
 
 __author__ = 'victorhooi'
 
 
-def create_point(timestamp, measurement_name, values, tags):
-    return {
-        "measurement": measurement_name,
-        "tags": tags,
-        "time": timestamp,
-        "fields": values
-    }
+# Line protocol encoders, keyed by measurement and tag set - the tags (project, hostname, version, pid) only change
+# when mongod is upgraded or restarted, so they are escaped once here rather than for every document.
+_encoders = {}
+
+
+def encode_point(timestamp, measurement_name, values, tags):
+    key = (measurement_name, tuple(tags.items()))
+    encoder = _encoders.get(key)
+    if encoder is None:
+        encoder = _encoders[key] = LineEncoder(measurement_name, tags)
+    return encoder.encode(timestamp, values)
+
+
+_timestamps = TimestampParser()
+
+
+def parse_local_time(local_time):
+    """Convert serverStatus's localTime to nanoseconds since the epoch."""
+    try:
+        return _timestamps.parse(local_time)
+    except (TypeError, ValueError):
+        # Not the ISO8601 format mongod writes - fall back to the slower, more forgiving parser
+        return timestamp_to_ns(local_time)
+
+
+_LOCAL_TIME = re.compile(r'"localTime"\s*:\s*"([^"]+)"')
+
+
+def line_time(line):
+    """Return the localTime of a line of serverStatus output in nanoseconds, without decoding the rest - or None."""
+    match = _LOCAL_TIME.search(line)
+    if match is None:
+        return None
+    try:
+        return parse_local_time(match.group(1))
+    except (ValueError, OverflowError):
+        return None
+
+
+# Which measurement the metrics in each section go to, when discovered (see discovered_metrics()) - the rest go to
+# "serverstatus"
+_SECTION_MEASUREMENTS = {
+    'wiredTiger': 'serverstatus_wiredtiger',
+    'backgroundFlushing': 'serverstatus_mmapv1',
+    'dur': 'serverstatus_mmapv1',
+}
+
+_CURATED_METRICS = {"serverstatus": common_metrics, "serverstatus_wiredtiger": wiredtiger_metrics,
+                    "serverstatus_mmapv1": mmapv1_metrics}
+
+# path: (measurement_name, metric_name) of every metric in serverstatus_metrics.py, so that discovered metrics keep
+# the names they've always had
+_CURATED_NAMES = {tuple(location): (measurement_name, metric_name)
+                  for measurement_name, metrics in _CURATED_METRICS.items()
+                  for metric_name, location in metrics.items()}
+
+# Numbers that are tags, or not metrics at all
+_NOT_METRICS = {('pid',), ('ok',)}
+
+
+def storage_engine(server_status_json):
+    """Return the storage engine's name - going by the sections in the document, for those from before 3.0."""
+    engine = server_status_json.get('storageEngine')
+    if isinstance(engine, dict) and 'name' in engine:
+        return engine['name']
+    return 'wiredTiger' if 'wiredTiger' in server_status_json else 'mmapv1'
 
 
-def strip_floatApprox_wrapping(field):
+def fingerprint(server_status_json):
     """
-    Strip the wrapping dict (floatApprox) around a value, if it exists.
-    :param field:
-    :return:
+    Return what decides the metrics in a serverStatus document - mongod's version and storage engine, and which
+    sections it has (which changes with things like replication or sharding being on).
     """
-    if isinstance(field, dict):
-        return field['floatApprox']
-    else:
-        return field
+    return server_status_json.get('version'), storage_engine(server_status_json), tuple(server_status_json)
+
+
+def curated_metrics(server_status_json):
+    """Return the metric definitions in serverstatus_metrics.py that apply to a document's storage engine."""
+    metrics = {"serverstatus": common_metrics}
+    if 'wiredTiger' in server_status_json:
+        metrics["serverstatus_wiredtiger"] = wiredtiger_metrics
+    if storage_engine(server_status_json) == 'mmapv1':
+        metrics["serverstatus_mmapv1"] = mmapv1_metrics
+    return metrics
+
+
+def discovered_metrics(server_status_json):
+    """
+    Return metric definitions for every number in a document - those in serverstatus_metrics.py under their usual
+    names, and the rest named after their path, with spaces replaced (e.g. wiredTiger.cache."pages read into cache"
+    becomes cache_pages_read_into_cache in serverstatus_wiredtiger).
+    """
+    metrics = {}
+    for path in numeric_paths(server_status_json):
+        if path in _NOT_METRICS:
+            continue
+        measurement_name, metric_name = _CURATED_NAMES.get(path, (None, None))
+        if measurement_name is None:
+            measurement_name = _SECTION_MEASUREMENTS.get(path[0], "serverstatus")
+            # wiredTiger's fields are named without the section, as in serverstatus_metrics.py
+            name_path = path[1:] if path[0] == 'wiredTiger' and len(path) > 1 else path
+            metric_name = '_'.join(name_path).replace(' ', '_')
+        # The first path to get a name keeps it
+        metrics.setdefault(measurement_name, {}).setdefault(metric_name, list(path))
+    return metrics
+
+
+# Paths we've already reported as missing, so that we only print each one once
+_reported_missing = set()
 
 
-def get_metrics(measurement_name, server_status_json, metrics_to_extract, line_number):
+def get_metrics(server_status_json, plan, line_number, project):
     """
-    Extracts a list of metrics from a server-status JSON object.
+    Extracts the metrics in a compiled MetricPlan from a server-status JSON object, in a single pass over the document.
     We also take a line-number, so that we can print it in any error messages.
-    Returns a list of metric tuples (timestamp, metric_name, value and tags)
+    Returns a list of (timestamp, measurement_name, values, tags) tuples - one per measurement in the plan.
     :return:
     """
-    values = {}
-
-    timestamp = server_status_json['localTime']
+    timestamp = parse_local_time(server_status_json['localTime'])
 
     # TODO - Deal with missing tags - e.g. storageEngine is only in 3.0+
     tags = {
-        'project': args.project,
+        'project': project,
         'hostname': server_status_json['host'].split(":")[0],
         'version': server_status_json['version'],
         # 'storage_engine': server_status_json['storageEngine']['name'],
-        'pid': strip_floatApprox_wrapping(server_status_json['pid'])
+        'pid': unwrap_number(server_status_json['pid'])
     }
 
-    for metric_name, location in metrics_to_extract.items():
-        try:
-            value = strip_floatApprox_wrapping(get_nested_items(server_status_json, *location))
-            values[metric_name] = float(value) # Should this always be a float?
-        # Handle missing fields.
-        except KeyError:
-            print("Unable to find the metric \"{}\" in line {}.".format(metric_name, line_number))
-        except TypeError:
-            print(line_number, metric_name, location)
-
-    # print(values)
-    # metrics.append((timestamp, metric_name, value, tags))
+    measurements, missing = plan.extract(server_status_json)
+    # Handle missing fields.
+    for path in missing:
+        if path not in _reported_missing:
+            _reported_missing.add(path)
+            print("Unable to find \"{}\" in line {}.".format('.'.join(path), line_number))
 
-    return (timestamp, measurement_name, values, tags)
+    return [(timestamp, measurement_name, values, tags) for measurement_name, values in measurements.items()]
 
 
 parser = argparse.ArgumentParser(description='Parse serverStatus() output, and load it into an InfluxDB instance')
@@ -75,38 +168,92 @@ parser.add_argument('-d', '--database', default="insight", help="Name of InfluxD
 parser.add_argument('-p', '--project', required=True, help='Project name to tag this with')
 parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
 parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+parser.add_argument('--dead-letter', help='File to save batches that could not be written to InfluxDB to, for replay_dead_letters.py. Defaults to <input_file>.deadletter.')
+parser.add_argument('-j', '--json-decoder', default='auto', choices=['auto', 'orjson', 'ujson', 'json', 'partial'], help="JSON decoder to use. 'auto' uses the fastest one installed, 'partial' only decodes the fields we extract. Defaults to auto.")
+parser.add_argument('--discover', action='store_true', default=False, help="Write every number in the documents, not just the metrics in serverstatus_metrics.py. The metrics are found in the first document from each mongod version, storage engine and set of sections, and read from later ones in the same way.")
+parser.add_argument('--no-rates', action='store_true', default=False, help="Don't write per-second rates of the counter metrics (to the <measurement>_rates measurements).")
+add_rollup_arguments(parser)
+add_follow_arguments(parser)
+add_checkpoint_arguments(parser)
+add_time_window_arguments(parser)
 parser.add_argument('input_file')
-args = parser.parse_args()
+
+def load(parser, args, logger, start=0, until=None, line_number=0):
+    """
+    Yield (points, line number, position) for each batch of serverStatus documents in args.input_file, between the
+    byte offsets start and until (None for the end of the file), then the last windows of any rollups (with no
+    position). position is as for PointWriter.write().
+    """
+    if args.discover and args.json_decoder == 'partial':
+        parser.error("--discover needs the whole of each document, so can't be used with -j partial")
+    # Only used by the 'partial' decoder - the tags plus every metric location
+    paths = [['host'], ['version'], ['pid'], ['localTime'], ['uptime'], ['storageEngine', 'name']]
+    for metric_definitions in _CURATED_METRICS.values():
+        paths.extend(metric_definitions.values())
+    decode = get_decoder(args.json_decoder, paths=paths)
+    # Counters are added as plans are built - only those in serverstatus_metrics.py, as there's no telling whether a
+    # discovered metric is a counter
+    rates = None if args.no_rates else CounterRates({})
+    select_metrics = discovered_metrics if args.discover else curated_metrics
+
+    def build_plan(server_status_json):
+        metrics = select_metrics(server_status_json)
+        if rates:
+            for measurement_name, metric_definitions in metrics.items():
+                rates.counters.setdefault(measurement_name, set()).update(
+                    metric_name for metric_name in counter_metrics(metric_definitions)
+                    if tuple(metric_definitions[metric_name]) in _CURATED_NAMES)
+        logger.info("Reading {} metrics from {} {} documents with {} sections".format(
+            sum(map(len, metrics.values())), *fingerprint(server_status_json)[:2], len(server_status_json)))
+        return MetricPlan(metrics)
+
+    plans = PlanCache(fingerprint, build_plan)
+    rollups = rollups_for_args(parser, args)
+    for batch in batches(open_lines(args, start, until), args.batch_size, args.max_latency / 1000):
+        points = []
+        for line, offset in batch:
+            line_number += 1
+            if line.strip():
+                try:
+                    server_status_json = decode(line)
+                    # print((line_number + 0) * _BATCH_SIZE)
+                    # print((line_number + 1) * _BATCH_SIZE)
+                    metric_data = get_metrics(server_status_json, plans.plan_for(server_status_json), line_number, args.project)
+                    if rates and metric_data:
+                        timestamp, _, _, tags = metric_data[0]
+                        measurements = {measurement_name: values for _, measurement_name, values, _ in metric_data}
+                        uptime = unwrap_number(server_status_json.get('uptime'))
+                        for measurement_name, values in rates.update(tags['hostname'], tags['pid'], uptime, timestamp, measurements):
+                            metric_data.append((timestamp, measurement_name + _RATES_SUFFIX, values, tags))
+                    for point in metric_data:
+                        if not args.rollup_only:
+                            points.append(encode_point(*point))
+                        for rollup in rollups:
+                            for rolled_up in rollup.add(*point):
+                                points.append(encode_point(*rolled_up))
+                except ValueError:
+                    logger.error("Line {} does not appear to be valid JSON - \"{}\"".format(line_number, line.strip()))
+        end = batch[-1][1]
+        yield [point for point in points if point], line_number, (start, end, line_number)
+        start = end
+    # The last window of each rollup
+    yield [encode_point(*rolled_up) for rollup in rollups for rolled_up in rollup.flush()], line_number, None
+
 
 def main():
+    args = parser.parse_args()
     logger = configure_logging('parse_serverstatus')
-    client = InfluxDBClient(host=args.influxdb_host, ssl=args.ssl, verify_ssl=False, port=8086, database=args.database)
-    with open(args.input_file, 'r') as f:
-        for line_number, chunk in enumerate(grouper(f, args.batch_size)):
-            # print(line_number)
-            json_points = []
-            for line in chunk:
-                # zip_longest will backfill any missing values with None, so we need to handle this, otherwise we'll miss the last batch
-                if line:
-                    try:
-                        server_status_json = json.loads(line)
-                        # print((line_number + 0) * _BATCH_SIZE)
-                        # print((line_number + 1) * _BATCH_SIZE)
-                        common_metric_data = get_metrics("serverstatus", server_status_json, common_metrics, line_number)
-                        json_points.append(create_point(*common_metric_data))
-                        wiredtiger_metric_data = get_metrics("serverstatus_wiredtiger", server_status_json, wiredtiger_metrics, line_number)
-                        json_points.append(create_point(*wiredtiger_metric_data))
-                        # for metric_data in get_metrics(server_status_json, common_metrics, line_number):
-                        #     import ipdb; ipdb.set_trace()
-                        #     print(json_points)
-                        #     json_points.append(create_point(*metric_data))
-                        # # for metric in get_metrics(server_status_json, wiredtiger_metrics, line_number):
-                        #     json_points.append(create_point(*metric))
-                        # for metric in get_metrics(server_status_json, mmapv1_metrics, line_number):
-                        #     json_points.append(create_point(*metric))
-                    except ValueError:
-                        logger.error("Line {} does not appear to be valid JSON - \"{}\"".format(line_number, line.strip()))
-            write_points(logger, client, json_points, line_number)
+    client_factory = sink_factory(parser, args)
+    since, until = window_for_args(parser, args, line_time, logger)
+    checkpoint = Checkpoint.for_args(args, logger)
+    start, line_number = (checkpoint.offset, checkpoint.line_number) if checkpoint and checkpoint.offset > since \
+        else (since, 0)
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter or args.input_file + '.deadletter',
+                     on_durable=checkpoint.save if checkpoint else None) as writer:
+        for points, line_number, position in load(parser, args, logger, start, until, line_number):
+            writer.write(points, line_number, position)
 if __name__ == "__main__":
     sys.exit(main())
-
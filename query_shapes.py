@@ -0,0 +1,267 @@
+import hashlib
+import re
+
+__author__ = 'victorhooi'
+
+# Tokens of the mongo shell-style documents mongod writes to its log - strings, constructor-style literals
+# (ObjectId('...'), new Date(...), BinData(0, ...), Timestamp 1439762895000|1), regular expressions, punctuation, and
+# anything else (numbers, true/false, field names) up to the next delimiter.
+_TOKENS = re.compile(r'''
+    "(?:[^"\\]|\\.)*"
+  | '(?:[^'\\]|\\.)*'
+  | (?:new\ )?\w+\([^)]*\)
+  | Timestamp\ \d+\|\d+
+  | /(?:[^/\\]|\\.)*/\w*
+  | [{}\[\],:]
+  | [^\s{}\[\],:]+
+''', re.VERBOSE)
+
+# Scalar literals that aren't field names (not followed by a colon) - replaced with ? before the (slower) full
+# normalization, so that queries differing only in their values share a cache entry.
+_LITERALS = re.compile(r'''
+    (?<![\w$.])
+    (?:"(?:[^"\\]|\\.)*"
+  | '(?:[^'\\]|\\.)*'
+  | (?:new\ )?\w+\([^)]*\)
+  | Timestamp\ \d+\|\d+
+  | -?\d[\w.+-]*(?![\w.+-])
+  | (?:true|false|null)\b
+    )(?!\s*:)
+''', re.VERBOSE)
+
+# The first value of a command document - the collection name, which is kept
+_FIRST_VALUE = re.compile(r'^\{\s*[^\s:]+:\s*(?:"(?:[^"\\]|\\.)*"|[^\s,}]+)')
+
+_BRACES = re.compile(r'[{}]|"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'')
+
+_SPACING = {'{': '{ ', '[': '[ ', '}': ' }', ']': ' ]', ':': ': ', ',': ', '}
+
+# Number of shapes cached by QueryShapes before the cache is cleared
+_CACHE_SIZE = 10000
+
+
+def document_at(line, start):
+    """Return the {...} document starting at line[start], or None if there isn't one. Braces in strings are skipped."""
+    if line[start:start + 1] != '{':
+        return None
+    depth = 0
+    # Only look at braces and (whole) strings, rather than every character
+    for match in _BRACES.finditer(line, start):
+        token = match.group()
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                return line[start:match.end()]
+    # mongod truncates very long documents - normalize what there is
+    return line[start:]
+
+
+def query_text(line, operation):
+    """
+    Find the query (or, for commands, the command document) in a slow operation's log line.
+    Returns (command name or None, document text), or None if the line doesn't have one.
+    """
+    if operation == 'command':
+        position = line.find(' command: ')
+        if position < 0:
+            return None
+        name, _, rest = line[position + 10:].partition(' ')
+        return name, document_at(rest, 0)
+    position = line.find(' query: ')
+    if position < 0:
+        return None
+    return None, document_at(line, position + 8)
+
+
+def normalize(text, keep_first=False):
+    """
+    Replace the literal values in a document with '?', leaving its field names, operators and structure - so that
+    { customer_id: 12, status: "A" } and { customer_id: 34, status: "B" } both become { customer_id: ?, status: ? }.
+
+    Arrays of values collapse to [ ? ], whatever their length, so $in queries with different numbers of values have
+    the same shape. Arrays of documents (e.g. $or clauses) keep the shape of each document.
+    :param keep_first: keep the first value as it is - for commands, where it is the collection name
+    """
+    output = []
+    # One entry per open document or array: True for documents, False for arrays
+    stack = []
+    expect_key = False
+    for token in _TOKENS.findall(text):
+        if token == '{':
+            output.append('{')
+            stack.append(True)
+            expect_key = True
+        elif token == '[':
+            output.append('[')
+            stack.append(False)
+            expect_key = False
+        elif token in '}]':
+            if stack:
+                stack.pop()
+            if output[-1] == ',':
+                output.pop()
+            output.append(token)
+            expect_key = False
+        elif token == ',':
+            if output[-1] not in ',[':
+                output.append(',')
+            expect_key = bool(stack) and stack[-1]
+        elif token == ':':
+            output.append(':')
+            expect_key = False
+        elif expect_key:
+            output.append(token)
+        elif keep_first:
+            output.append(token)
+            keep_first = False
+        elif stack and not stack[-1]:
+            # A value in an array - only the first is kept
+            if output[-1] == '[':
+                output.append('?')
+            elif output[-1] == ',':
+                output.pop()
+        else:
+            output.append('?')
+    shape = []
+    for token in output:
+        if token in ('}', ']') and shape and shape[-1] in ('{ ', '[ '):
+            # Empty document or array
+            shape[-1] = shape[-1][0] + token
+        else:
+            shape.append(_SPACING.get(token, token))
+    return ''.join(shape)
+
+
+def shape_id(namespace, operation, command, shape):
+    """A stable id for a query shape - the same across runs and processes, unlike hash()."""
+    key = '\0'.join((namespace or '', operation or '', command or '', shape))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+class _Shape:
+    __slots__ = ('namespace', 'operation', 'command', 'shape', 'count', 'total_duration', 'max_duration',
+                 'docs_examined', 'nreturned', 'collscans', 'last_seen')
+
+    def __init__(self, namespace, operation, command, shape):
+        self.namespace = namespace
+        self.operation = operation
+        self.command = command
+        self.shape = shape
+        self.count = 0
+        self.total_duration = 0
+        self.max_duration = 0
+        self.docs_examined = 0
+        self.nreturned = 0
+        self.collscans = 0
+        self.last_seen = 0
+
+    def merge(self, other):
+        self.count += other.count
+        self.total_duration += other.total_duration
+        self.max_duration = max(self.max_duration, other.max_duration)
+        self.docs_examined += other.docs_examined
+        self.nreturned += other.nreturned
+        self.collscans += other.collscans
+        self.last_seen = max(self.last_seen, other.last_seen)
+
+    def values(self):
+        return {
+            'count': self.count,
+            'duration_total': self.total_duration,
+            'duration_mean': self.total_duration / self.count,
+            'duration_max': self.max_duration,
+            'docs_examined': self.docs_examined,
+            'nreturned': self.nreturned,
+            # A well indexed query examines about as many documents as it returns
+            'examined_per_returned': self.docs_examined / max(self.nreturned, 1),
+            'collscan': self.collscans > 0,
+            'shape': self.shape,
+        }
+
+
+class QueryShapes:
+    """
+    Groups slow operations by query shape - namespace, operation and the query with its literal values replaced
+    (see normalize()) - and keeps count, duration, documents examined and returned, and COLLSCANs for each.
+
+    Applications send the same handful of queries over and over, so shapes are cached by the query text with its
+    scalar values blanked out by a single regular expression substitution, and only normalized (and hashed) the
+    first time each one is seen. Shapes from worker processes are combined with merge(), which gives the same totals
+    as a single process.
+    """
+    def __init__(self):
+        # shape id: _Shape
+        self.shapes = {}
+        # (namespace, operation, command, query text with literals blanked): shape id
+        self._cache = {}
+
+    def add(self, line, timestamp, values, tags):
+        """Add a slow operation - its log line, and the (timestamp, values, tags) from parse_operation()."""
+        operation = tags.get('operation')
+        found = query_text(line, operation)
+        if found is None or found[1] is None:
+            return
+        command, text = found
+        namespace = tags.get('namespace')
+        kept = _FIRST_VALUE.match(text) if command is not None else None
+        if kept:
+            text = text[:kept.end()] + _LITERALS.sub('?', text[kept.end():])
+        else:
+            text = _LITERALS.sub('?', text)
+        cache_key = (namespace, operation, command, text)
+        key = self._cache.get(cache_key)
+        if key is None:
+            shape = normalize(text, keep_first=kept is not None)
+            key = shape_id(namespace, operation, command, shape)
+            if key not in self.shapes:
+                self.shapes[key] = _Shape(namespace, operation, command, shape)
+            if len(self._cache) >= _CACHE_SIZE:
+                self._cache.clear()
+            self._cache[cache_key] = key
+        stats = self.shapes[key]
+        duration = values['duration_in_milliseconds']
+        stats.count += 1
+        stats.total_duration += duration
+        if duration > stats.max_duration:
+            stats.max_duration = duration
+        # docsExamined in 3.2+, nscannedObjects before
+        stats.docs_examined += values.get('docsExamined', values.get('nscannedObjects', 0))
+        stats.nreturned += values.get('nreturned', 0)
+        if tags.get('plan_summary') == 'COLLSCAN':
+            stats.collscans += 1
+        if timestamp > stats.last_seen:
+            stats.last_seen = timestamp
+
+    def merge(self, shapes):
+        """Merge in the shapes of another QueryShapes - e.g. one from a worker process."""
+        for key, shape in shapes.items():
+            existing = self.shapes.get(key)
+            if existing is None:
+                self.shapes[key] = shape
+            else:
+                existing.merge(shape)
+
+    def ranked(self):
+        """Shapes, as (shape id, _Shape), with the most total time spent first."""
+        return sorted(self.shapes.items(), key=lambda item: (-item[1].total_duration, item[0]))
+
+    def points(self):
+        """A (timestamp, values, tags) point per shape, timestamped with its last operation."""
+        return [(shape.last_seen, shape.values(),
+                 {'namespace': shape.namespace, 'operation': shape.operation, 'command': shape.command,
+                  'shape_id': key})
+                for key, shape in self.ranked()]
+
+    def report(self, limit):
+        """The top limit shapes by total time, as lines of text."""
+        lines = ['{:>8} {:>10} {:>8} {:>8} {:>9}  {}'.format('count', 'total ms', 'mean ms', 'max ms', 'exam/ret',
+                                                               'shape')]
+        for key, shape in self.ranked()[:limit]:
+            values = shape.values()
+            lines.append('{:>8} {:>10} {:>8.0f} {:>8} {:>9.1f}  {}{} {} {} {}'.format(
+                shape.count, shape.total_duration, values['duration_mean'], shape.max_duration,
+                values['examined_per_returned'], 'COLLSCAN ' if values['collscan'] else '', shape.namespace,
+                shape.command or shape.operation, shape.shape, key))
+        return lines
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from utils import configure_logging
+from writer import PointWriter
+from sinks import add_sink_arguments, sink_factory
+
+__author__ = 'victorhooi'
+
+
+def read_batches(dead_letter_file):
+    """Yield (points, line_number) for each batch saved in a dead-letter file by PointWriter."""
+    points = []
+    line_number = None
+    with open(dead_letter_file, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\n')
+            if line.startswith(b'# Batch ending at line '):
+                if points:
+                    yield points, line_number
+                points = []
+                line_number = line.rsplit(None, 1)[1].decode('utf-8')
+            elif line:
+                points.append(line)
+    if points:
+        yield points, line_number
+
+
+parser = argparse.ArgumentParser(description='Replay batches that the parsers could not write to InfluxDB')
+parser.add_argument('-d', '--database', default="insight", help="Name of InfluxDB database to write to. Defaults to 'insight'.")
+parser.add_argument('-i', '--influxdb-host', default='localhost', help='InfluxDB instance to connect to. Defaults to localhost.')
+parser.add_argument('-s', '--ssl', action='store_true', default=False, help='Enable SSl mode for InfluxDB.')
+parser.add_argument('-w', '--writer-threads', default=4, type=int, help='Number of concurrent threads writing to InfluxDB. Defaults to 4.')
+add_sink_arguments(parser)
+parser.add_argument('dead_letter_file')
+
+
+def main():
+    args = parser.parse_args()
+    logger = configure_logging('replay_dead_letters')
+    client_factory = sink_factory(parser, args)
+    # Anything that fails again goes to a new file, rather than being appended to the one we're reading
+    with PointWriter(logger, client_factory, threads=args.writer_threads,
+                     dead_letter_file=args.dead_letter_file + '.retry') as writer:
+        for points, line_number in read_batches(args.dead_letter_file):
+            writer.write(points, line_number)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import re
+
+__author__ = 'victorhooi'
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def parse_window(text):
+    """Parse a window length like '10s', '1m' or '1h' into nanoseconds."""
+    match = re.match(r'^(\d+)([smh])$', text)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("Unrecognised rollup window \"{}\" - use e.g. 10s, 1m or 1h".format(text))
+    return int(match.group(1)) * _UNITS[match.group(2)] * 1000000000
+
+
+def add_rollup_arguments(parser):
+    parser.add_argument('--rollup', action='append', default=[], metavar='WINDOW', help='Also write min, max, mean and last of every field over windows of this length (e.g. 10s, 1m or 1h), to <measurement>_<window>. Can be given more than once.')
+    parser.add_argument('--rollup-only', action='store_true', default=False, help='Only write the rollups, not the raw points.')
+
+
+def rollups_for_args(parser, args, percentiles=()):
+    """Return a Rollup for each --rollup window, exiting with a usage message if one can't be parsed."""
+    if args.rollup_only and not args.rollup:
+        parser.error("--rollup-only needs at least one --rollup window")
+    try:
+        return [Rollup(parse_window(window), window, percentiles) for window in args.rollup]
+    except ValueError as e:
+        parser.error(str(e))
+
+
+class _Window:
+    __slots__ = ('start', 'tags', 'stats', 'samples')
+
+    def __init__(self, start, tags):
+        self.start = start
+        self.tags = tags
+        # field: [min, max, total, count, last]
+        self.stats = {}
+        # field: [values], for the fields we take percentiles of
+        self.samples = {}
+
+
+def _percentile(values, percentile):
+    """Nearest-rank percentile of a list of values."""
+    values = sorted(values)
+    return values[max(0, -(-len(values) * percentile // 100) - 1)]
+
+
+class Rollup:
+    """
+    Aggregates points into fixed time windows - min, max, mean and last of each field, plus 95th percentiles of
+    selected fields - for each series (measurement and tags).
+
+    Input is expected to be in time order, as it is in a capture file. Only the current window of each series is
+    held, so memory use depends on the number of series, not on the length of the input: a window is finished as
+    soon as a later point for the same series arrives, or once the input has moved a whole window past it (for
+    series that have stopped reporting). Rolled up points are timestamped with the start of their window.
+    """
+    def __init__(self, window, label, percentiles=()):
+        """
+        :param window: window length in nanoseconds
+        :param label: suffix for the rollup measurements, e.g. '1m' gives 'iostat_1m'
+        :param percentiles: names of the fields to also take the 95th percentile of
+        """
+        self.window = window
+        self.label = label
+        self.percentiles = set(percentiles)
+        self._windows = {}
+        self._next_sweep = None
+
+    def add(self, timestamp, measurement_name, values, tags=None):
+        """
+        Add a point (timestamp in nanoseconds), returning any windows it finishes as a list of
+        (timestamp, measurement_name, values, tags) tuples.
+        """
+        key = (measurement_name, tuple(tags.items()) if tags else ())
+        start = timestamp - timestamp % self.window
+        finished = []
+        window = self._windows.get(key)
+        if window is not None and window.start != start:
+            finished.append(self._finish(key, window))
+            window = None
+        if window is None:
+            window = self._windows[key] = _Window(start, tags)
+        stats = window.stats
+        for field, value in values.items():
+            if value is None:
+                continue
+            field_stats = stats.get(field)
+            if field_stats is None:
+                stats[field] = [value, value, value, 1, value]
+            else:
+                if value < field_stats[0]:
+                    field_stats[0] = value
+                if value > field_stats[1]:
+                    field_stats[1] = value
+                field_stats[2] += value
+                field_stats[3] += 1
+                field_stats[4] = value
+            if field in self.percentiles:
+                window.samples.setdefault(field, []).append(value)
+        if self._next_sweep is None or timestamp >= self._next_sweep:
+            finished.extend(self._sweep(start - self.window))
+            self._next_sweep = start + self.window
+        return finished
+
+    def flush(self):
+        """Finish every window still open - at the end of the input."""
+        finished = [self._finish(key, window) for key, window in self._windows.items()]
+        self._windows.clear()
+        return finished
+
+    def _sweep(self, before):
+        """Finish windows that started before a given time, for series that have gone quiet."""
+        stale = [key for key, window in self._windows.items() if window.start < before]
+        return [self._finish(key, self._windows.pop(key)) for key in stale]
+
+    def _finish(self, key, window):
+        values = {}
+        for field, (minimum, maximum, total, count, last) in window.stats.items():
+            values[field + '_min'] = minimum
+            values[field + '_max'] = maximum
+            values[field + '_mean'] = total / count
+            values[field + '_last'] = last
+        for field, samples in window.samples.items():
+            values[field + '_p95'] = _percentile(samples, 95)
+        return window.start, '{}_{}'.format(key[0], self.label), values, window.tags
@@ -204,4 +204,72 @@ wiredtiger_metrics = {
     'reconciliation_page_reconciliation_calls_for_eviction': ['wiredTiger', 'reconciliation', 'page reconciliation calls for eviction'],
     'reconciliation_split_objects_currently_awaiting_free': ['wiredTiger', 'reconciliation', 'split objects currently awaiting free'],
     'reconciliation_split_bytes_currently_awaiting_free': ['wiredTiger', 'reconciliation', 'split bytes currently awaiting free'],
-}
\ No newline at end of file
+}
+
+# Metrics that are levels at the time of the sample (connections open, bytes in the cache, tickets available, etc.).
+# Every other metric is a counter - a running total since mongod started - and also gets a per-second rate.
+gauge_metrics = {
+    'connections_available',
+    'connections_current',
+    'extra_info_heap_usage_bytes',
+    'global_lock_active_clients_readers',
+    'global_lock_active_clients_total',
+    'global_lock_active_clients_writers',
+    'global_lock_current_queue_readers',
+    'global_lock_current_queue_total',
+    'global_lock_current_queue_writers',
+    'tcmalloc_generic_current_allocated_bytes',
+    'tcmalloc_generic_heap_size',
+    'tcmalloc_tcmalloc_aggressive_memory_decommit',
+    'tcmalloc_tcmalloc_central_cache_free_bytes',
+    'tcmalloc_tcmalloc_current_total_thread_cache_bytes',
+    'tcmalloc_tcmalloc_max_total_thread_cache_bytes',
+    'tcmalloc_tcmalloc_pageheap_free_bytes',
+    'tcmalloc_tcmalloc_pageheap_unmapped_bytes',
+    'tcmalloc_tcmalloc_thread_cache_free_bytes',
+    'tcmalloc_tcmalloc_transfer_cache_free_bytes',
+    'mem_resident',
+    'mem_virtual',
+    'mem_mapped',
+    'mem_mapped_with_journal',
+    'metrics_cursor_open_notimeout',
+    'metrics_cursor_open_pinned',
+    'metrics_cursor_open_total',
+    'background_flushing_average_ms',
+    'background_flushing_last_ms',
+    'log_total_log_buffer_size',
+    'log_maximum_log_file_size',
+    'log_number_of_pre-allocated_log_files_to_create',
+    'cache_maximum_page_size_at_eviction',
+    'cache_tracked_bytes_belonging_to_leaf_pages_in_the_cache',
+    'cache_tracked_dirty_bytes_in_the_cache',
+    'cache_pages_currently_held_in_the_cache',
+    'cache_tracked_dirty_pages_in_the_cache',
+    'cache_bytes_currently_in_the_cache',
+    'cache_tracked_bytes_belonging_to_overflow_pages_in_the_cache',
+    'cache_percentage_overhead',
+    'cache_maximum_bytes_configured',
+    'cache_tracked_bytes_belonging_to_internal_pages_in_the_cache',
+    'transaction_transaction_checkpoint_min_time_(msecs)',
+    'transaction_transaction_checkpoint_currently_running',
+    'transaction_transaction_range_of_IDs_currently_pinned',
+    'transaction_transaction_checkpoint_max_time_(msecs)',
+    'transaction_transaction_checkpoint_most_recent_time_(msecs)',
+    'transaction_transaction_range_of_IDs_currently_pinned_by_a_checkpoint',
+    'connection_files_currently_open',
+    'session_open_session_count',
+    'session_open_cursor_count',
+    'concurrentTransactions_read_out',
+    'concurrentTransactions_read_available',
+    'concurrentTransactions_read_totalTickets',
+    'concurrentTransactions_write_out',
+    'concurrentTransactions_write_available',
+    'concurrentTransactions_write_totalTickets',
+    'reconciliation_split_objects_currently_awaiting_free',
+    'reconciliation_split_bytes_currently_awaiting_free',
+}
+
+
+def counter_metrics(metrics):
+    """Return the names of the counters in a dict of metric definitions."""
+    return {metric_name for metric_name in metrics if metric_name not in gauge_metrics}
@@ -0,0 +1,225 @@
+import bisect
+import json
+import os
+from line_protocol import timestamp_to_ns
+from datetime import datetime
+from timestamps import CTIME, TimestampParser, ctime_month, detect_format
+from checkpoint import hash_range
+from inputs import compression
+
+__author__ = 'victorhooi'
+
+# Once the search is down to this many bytes, the lines left are read one by one instead of probed
+_SCAN_SIZE = 64 * 1024
+
+# How much of the start of the input file the index's hash covers - enough to tell a rotated file from the old one
+_HEAD_SIZE = 4096
+
+
+def add_time_window_arguments(parser):
+    parser.add_argument('--since', help='Only load lines from this time onwards - e.g. "2015-08-16T22:00:00Z". Times without a UTC offset are taken as UTC. The input file must be in time order: the start is found by a binary search, so the rest of the file is never read.')
+    parser.add_argument('--until', help='Only load lines from before this time, and stop reading the input file there. Can\'t be used with --follow.')
+    parser.add_argument('--time-index', help='File to keep the offsets found by --since and --until in, so that later searches of the same input file start from them. Defaults to <input_file>.timeindex.')
+
+
+def _first_timestamped_line(f):
+    for line in f:
+        line = line.decode('utf-8', errors='replace')
+        try:
+            detect_format(line)
+        except ValueError:
+            continue
+        return line
+    return None
+
+
+def ctime_years(input_file, offsets):
+    """
+    Return the year that a TimestampParser reading a 2.4 log from the start would be in at each of offsets (in
+    increasing order) - 2.4 timestamps have no year, so the parser starts at the current year and moves on to the next
+    whenever the month goes down. Assumes less than a year passes between one offset and the next. Returns None for
+    each offset if the log isn't in 2.4 format (or is compressed, so can't be seeked into), for the parser's default.
+    """
+    if compression(input_file):
+        return [None] * len(offsets)
+    with open(input_file, 'rb') as f:
+        line = _first_timestamped_line(f)
+        if line is None or detect_format(line) != CTIME:
+            return [None] * len(offsets)
+        year = datetime.now().year
+        month = ctime_month(line)
+        years = []
+        for offset in offsets:
+            # As in TimeIndex._probe
+            f.seek(max(offset - 1, 0))
+            if offset:
+                f.readline()
+            line = _first_timestamped_line(f)
+            if line is not None:
+                if ctime_month(line) < month:
+                    year += 1
+                month = ctime_month(line)
+            years.append(year)
+        return years
+
+
+def log_time(input_file, tz=None):
+    """
+    Return a function giving the timestamp of a line of the mongod log input_file in nanoseconds, or None if it
+    doesn't have one. 2.4 lines have no year, and are read out of order here, so each is given the first year that
+    doesn't put it before the start of the log - the year a parser reading the log from the start would give it.
+    """
+    # The timestamp of the first line, once a 2.4 line needs it
+    first = []
+
+    def timestamp_of(line):
+        try:
+            # A new parser each time, since the lines are read out of order
+            timestamps = TimestampParser(tz=tz)
+            timestamp = timestamps.split(line)[0]
+            if timestamps.format != CTIME:
+                return timestamp
+            if not first:
+                with open(input_file, 'rb') as f:
+                    first.append(TimestampParser(tz=tz).split(_first_timestamped_line(f))[0])
+            if timestamp < first[0]:
+                timestamp = TimestampParser(tz=tz, year=timestamps.year + 1).split(line)[0]
+            return timestamp
+        except (ValueError, KeyError):
+            return None
+    return timestamp_of
+
+
+class TimeIndex:
+    """
+    Finds where times are in a time-ordered input file, by binary search on byte offsets. Each probe seeks to an
+    offset, skips on to the start of the next line, and reads forward to the first line with a timestamp.
+
+    The (offset, timestamp) of each line probed is kept, and saved to a small JSON file, so a later search of the same
+    file starts from the nearest known offsets - searching for a time again only reads a few KB. The index stays
+    valid as the file is appended to, but is thrown away if the file is replaced or changed.
+    """
+    def __init__(self, path, input_file, timestamp_of):
+        """
+        :param timestamp_of: function returning the timestamp of a line (str) in nanoseconds, or None
+        """
+        self.path = path
+        self.input_file = input_file
+        self.timestamp_of = timestamp_of
+        # Sorted (offset, timestamp) of line starts
+        self.entries = []
+        self.probes = 0
+        self.size = os.path.getsize(input_file)
+        self._head_hash = hash_range(input_file, 0, _HEAD_SIZE)
+
+    def load(self, logger):
+        """Load the saved entries, unless the input file has been replaced or changed since they were saved."""
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return self
+        entries = [tuple(entry) for entry in saved['entries']]
+        if saved['inode'] != os.stat(self.input_file).st_ino or saved['head_sha1'] != self._head_hash or \
+                (entries and entries[-1][0] >= self.size):
+            logger.warning("{} no longer matches {} - ignoring it".format(self.input_file, self.path))
+            return self
+        self.entries = entries
+        return self
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'input_file': self.input_file, 'inode': os.stat(self.input_file).st_ino,
+                       'head_sha1': self._head_hash, 'entries': self.entries}, f)
+        os.replace(temp_path, self.path)
+
+    def _add(self, offset, timestamp):
+        entry = (offset, timestamp)
+        position = bisect.bisect_left(self.entries, entry)
+        if position == len(self.entries) or self.entries[position] != entry:
+            self.entries.insert(position, entry)
+
+    def _bounds(self, target):
+        """Return (lo, hi) - the last known line start before target, and the first at or after it."""
+        lo, hi = 0, self.size
+        for offset, timestamp in self.entries:
+            if timestamp < target:
+                lo = offset
+            else:
+                hi = offset
+                break
+        return lo, hi
+
+    def _probe(self, f, offset, limit):
+        """Return the (offset, timestamp) of the first line with a timestamp starting in [offset, limit), or None."""
+        self.probes += 1
+        # Step back a byte, so that a line starting right at offset isn't skipped
+        f.seek(offset - 1)
+        f.readline()
+        position = f.tell()
+        while position < limit:
+            line = f.readline()
+            if not line:
+                break
+            timestamp = self.timestamp_of(line.decode('utf-8', errors='replace'))
+            if timestamp is not None:
+                return position, timestamp
+            position += len(line)
+        return None
+
+    def find(self, target):
+        """Return the byte offset of the first line with a timestamp at or after target (in nanoseconds)."""
+        lo, hi = self._bounds(target)
+        # Lines starting between limit and hi have no timestamp, so hi is the answer unless one before limit is
+        limit = hi
+        with open(self.input_file, 'rb') as f:
+            while limit - lo > _SCAN_SIZE:
+                middle = (lo + limit) // 2
+                found = self._probe(f, middle, limit)
+                if found is None:
+                    limit = middle
+                    continue
+                self._add(*found)
+                if found[1] < target:
+                    lo = found[0]
+                else:
+                    hi = limit = found[0]
+            f.seek(lo)
+            position = lo
+            while position < limit:
+                line = f.readline()
+                if not line:
+                    break
+                timestamp = self.timestamp_of(line.decode('utf-8', errors='replace'))
+                if timestamp is not None and timestamp >= target:
+                    self._add(position, timestamp)
+                    return position
+                position += len(line)
+        return hi
+
+
+def window_for_args(parser, args, timestamp_of, logger):
+    """
+    Return the (start, end) byte offsets of the lines between --since and --until in the input file - end is None
+    if there's no --until.
+    :param timestamp_of: function returning the timestamp of a line (str) in nanoseconds, or None
+    """
+    if args.since is None and args.until is None:
+        return 0, None
+    if args.until is not None and args.follow:
+        parser.error("--until can't be used with --follow")
+    if compression(args.input_file):
+        # Compressed files can't be seeked into, so there's nothing to gain over filtering every line
+        parser.error("--since and --until can't be used with a compressed input file")
+    try:
+        since, until = [timestamp_to_ns(time) if time is not None else None for time in (args.since, args.until)]
+    except (ValueError, OverflowError) as e:
+        parser.error("Unrecognised --since or --until time - {}".format(e))
+    index = TimeIndex(args.time_index or args.input_file + '.timeindex', args.input_file, timestamp_of).load(logger)
+    start = index.find(since) if since is not None else 0
+    end = index.find(until) if until is not None else None
+    index.save()
+    logger.info("Loading bytes {} to {} of {} ({} probes)".format(start, end if end is not None else index.size,
+                                                                 index.size, index.probes))
+    return start, end
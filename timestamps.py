@@ -0,0 +1,122 @@
+import calendar
+from datetime import datetime, timezone
+
+__author__ = 'victorhooi'
+
+# mongod logs use one of a handful of timestamp formats:
+#   3.x: 2015-08-16T22:28:15.350Z
+#   2.6: 2015-09-01T01:14:36.759-0700
+#   2.4: Wed Sep  2 01:14:36.759 (local time, no year or UTC offset)
+ISO8601 = 'iso8601'
+CTIME = 'ctime'
+
+_MONTHS = {name: number for number, name in enumerate(calendar.month_abbr) if name}
+
+
+def detect_format(line):
+    """Return the timestamp format used by a log line."""
+    if line[4:5] == '-' and line[10:11] == 'T':
+        return ISO8601
+    if line[:3] in calendar.day_abbr and line[4:7] in _MONTHS:
+        return CTIME
+    raise ValueError("Unrecognised timestamp - {}".format(line[:30]))
+
+
+def ctime_month(line):
+    """Return the month (1-12) of a 2.4 log line, or None if it doesn't start with a 2.4 timestamp."""
+    return _MONTHS.get(line[4:7]) if line[:3] in calendar.day_abbr else None
+
+
+def parse_utc_offset(suffix):
+    """Parse a 'Z', '+hhmm' or '+hh:mm' suffix into an offset from UTC in seconds."""
+    if suffix in ('', 'Z'):
+        return 0
+    sign = -1 if suffix[0] == '-' else 1
+    digits = suffix[1:].replace(':', '')
+    if len(digits) != 4 or not digits.isdigit():
+        raise ValueError("Unrecognised UTC offset - {}".format(suffix))
+    return sign * (int(digits[:2]) * 3600 + int(digits[2:]) * 60)
+
+
+class TimestampParser:
+    """
+    Parses the timestamps at the start of mongod log lines into nanoseconds since the epoch.
+
+    The format is detected from the first line, and the epoch seconds for the current date (or hour, for 2.4) and
+    the UTC offset are cached, since consecutive lines almost always share them. Use one parser per file.
+    """
+    def __init__(self, tz=None, year=None):
+        """
+        :param tz: timezone for 2.4 logs, which are written in the server's local time. Defaults to UTC.
+        :param year: year for 2.4 logs, which don't include one. Defaults to the current year.
+        """
+        self.tz = tz or timezone.utc
+        self.year = year or datetime.now().year
+        self.format = None
+        self._date = None
+        self._date_seconds = None
+        self._suffix = None
+        self._offset = None
+        self._hour = None
+        self._hour_seconds = None
+        self._month = None
+
+    def split(self, line):
+        """Split a log line into (timestamp in nanoseconds, rest of the line)."""
+        if self.format is None:
+            self.format = detect_format(line)
+        if self.format == CTIME:
+            weekday, month, day, time, rest = line.split(None, 4)
+            return self._parse_ctime(month, day, time), rest
+        timestamp, rest = line.split(None, 1)
+        return self._parse_iso8601(timestamp), rest
+
+    def parse(self, timestamp):
+        """Parse a single timestamp string into nanoseconds since the epoch."""
+        if self.format is None:
+            self.format = detect_format(timestamp)
+        if self.format == CTIME:
+            weekday, month, day, time = timestamp.split()
+            return self._parse_ctime(month, day, time)
+        return self._parse_iso8601(timestamp)
+
+    def _parse_iso8601(self, timestamp):
+        date = timestamp[:10]
+        if date != self._date:
+            self._date_seconds = calendar.timegm((int(date[:4]), int(date[5:7]), int(date[8:10]), 0, 0, 0))
+            self._date = date
+        if timestamp[19:20] == '.':
+            end = 20
+            while timestamp[end:end + 1].isdigit():
+                end += 1
+            nanoseconds = int(timestamp[20:end].ljust(9, '0')[:9])
+        else:
+            end = 19
+            nanoseconds = 0
+        suffix = timestamp[end:]
+        if suffix != self._suffix:
+            self._offset = parse_utc_offset(suffix)
+            self._suffix = suffix
+        seconds = (self._date_seconds + int(timestamp[11:13]) * 3600 + int(timestamp[14:16]) * 60 +
+                   int(timestamp[17:19]) - self._offset)
+        return seconds * 1000000000 + nanoseconds
+
+    def _parse_ctime(self, month, day, time):
+        hour = (month, day, time[:2])
+        if hour != self._hour:
+            month_number = _MONTHS[month]
+            if self._month is not None and month_number < self._month:
+                # The log has rolled over into a new year
+                self.year += 1
+            self._month = month_number
+            local = datetime(self.year, month_number, int(day), int(time[:2]))
+            if hasattr(self.tz, 'localize'):
+                # pytz timezones need localize() to pick the right DST offset
+                local = self.tz.localize(local)
+            else:
+                local = local.replace(tzinfo=self.tz)
+            self._hour_seconds = calendar.timegm(local.utctimetuple())
+            self._hour = hour
+        seconds, _, fraction = time[6:].partition('.')
+        return ((self._hour_seconds + int(time[3:5]) * 60 + int(seconds)) * 1000000000 +
+                int(fraction.ljust(9, '0')[:9]))
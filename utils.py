@@ -1,9 +1,5 @@
 from itertools import zip_longest
 import logging
-from requests.exceptions import RequestException
-from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
-from requests.exceptions import SSLError
-from retrying import retry
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -29,23 +25,3 @@ def configure_logging(logger_name):
     ch.setFormatter(formatter)
     logger.addHandler(ch)
     return logger
-
-@retry(stop_max_attempt_number=5, wait_exponential_multiplier=1000, wait_exponential_max=120000)
-def write_points(logger, client, json_points, line_number):
-    # TODO - I originally wrote this to reduce code duplication - however, we need a better way to handle all the parameters
-    # TODO - We need a better way to handle retry behaviour, without needing to re-raise exceptions
-    try:
-        client.write_points(json_points)
-        logger.info("Wrote in {} points to InfluxDB. Processed up to line {}.".format(len(json_points), line_number))
-    except RequestException as e:
-        logger.error("Unable to connect to InfluxDB at {} - {}".format(client._host, e))
-        logger.info("Retrying...")
-        raise Exception
-    except InfluxDBClientError as e:
-        logger.error('Unable to write to InfluxDB - {}'.format(e))
-        logger.info("Retrying...")
-        raise Exception
-    except SSLError as e:
-        logger.error('SSL error - {}'.format(e))
-        logger.info("Retrying...")
-        raise Exception
\ No newline at end of file
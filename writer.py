@@ -0,0 +1,336 @@
+import math
+import queue
+import threading
+import time
+from influxdb.line_protocol import make_lines
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
+from retrying import Retrying
+
+__author__ = 'victorhooi'
+
+# Sentinel put on the queue to tell a worker thread to exit
+_STOP = object()
+
+
+class WriterStats:
+    """Thread-safe counters describing how the writer is keeping up."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self.points = 0
+        self.batches = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.retries = 0
+        self.failed_batches = 0
+
+    def batch_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def batch_finished(self, points, failed=False):
+        with self._lock:
+            self.in_flight -= 1
+            if failed:
+                self.failed_batches += 1
+            else:
+                self.batches += 1
+                self.points += points
+
+    def request_sent(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def points_per_second(self):
+        elapsed = time.time() - self.start_time
+        return self.points / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return "{} points in {} batches and {} requests ({:.0f} points/s), {} in-flight, {} retries, {} failed batches".format(
+            self.points, self.batches, self.requests, self.points_per_second(), self.in_flight, self.retries,
+            self.failed_batches)
+
+
+class BatchSizer:
+    """
+    Decides how much to send to the sink per request, going by how long requests take.
+
+    Requests are limited to max_points points, and to a target size in bytes (of line protocol, before any
+    compression). The target grows while requests of about that size finish well within target_latency, and shrinks
+    when they take longer, or fail - so it settles on the largest requests the server handles comfortably, whether
+    the points are narrow (connections) or wide (serverStatus).
+    """
+    def __init__(self, target_latency=1.0, target_bytes=1024 * 1024, min_bytes=64 * 1024, max_bytes=16 * 1024 * 1024,
+                 max_points=10000):
+        """
+        :param target_latency: seconds a request should take at most
+        :param target_bytes: size in bytes to start from, kept between min_bytes and max_bytes
+        """
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.max_points = max_points
+        # The smallest request that has failed, which the target is kept under
+        self._ceiling = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def size(points):
+        """Return the size in bytes of a batch of line protocol lines, or None for point dicts."""
+        if points and isinstance(points[0], bytes):
+            return sum(map(len, points)) + len(points)
+        return None
+
+    def split(self, points, size=None):
+        """Split points into evenly sized requests, within the current limits."""
+        requests = math.ceil(len(points) / self.max_points)
+        if size is not None:
+            requests = max(requests, math.ceil(size / self.target_bytes))
+        if requests <= 1:
+            return [points]
+        # Points in a batch are much the same size, so an even count per request is an even size
+        count = math.ceil(len(points) / requests)
+        return [points[i:i + count] for i in range(0, len(points), count)]
+
+    def record(self, size, elapsed):
+        """Adjust the target after a request of size bytes succeeded in elapsed seconds."""
+        if size is None:
+            return
+        with self._lock:
+            if elapsed > self.target_latency:
+                self.target_bytes = max(self.min_bytes, int(self.target_bytes * 0.7))
+            elif elapsed < self.target_latency / 2 and size >= self.target_bytes / 2:
+                # Only grow on requests near the target - small ones being quick says little about big ones
+                if self._ceiling is not None:
+                    # Creep back up towards the size that failed, in case that was a passing problem
+                    self._ceiling = int(self._ceiling * 1.002)
+                limit = self.max_bytes if self._ceiling is None else min(self.max_bytes, int(self._ceiling * 0.8))
+                self.target_bytes = max(self.target_bytes, min(limit, int(self.target_bytes * 1.25)))
+
+    def failed(self, size):
+        """
+        Halve the target after a request of size bytes failed - most often a timeout, from sending too much at once.
+        The target doesn't grow back to that size until requests just below it have gone through for a while.
+        """
+        with self._lock:
+            # Relative to the request's size, not the target - so requests failing together only halve it once
+            self.target_bytes = max(self.min_bytes, min(self.target_bytes, (size or self.target_bytes) // 2))
+            if size is not None:
+                self._ceiling = size if self._ceiling is None else min(self._ceiling, size)
+
+
+class PointWriter:
+    """
+    Writes batches of points to a sink (InfluxDB, or local files - see sinks.py) from a pool of background threads.
+
+    Parsers hand batches to write(), which only blocks when the queue is full (backpressure), so parsing
+    carries on while earlier batches are on the wire. Each worker owns its own sink - and therefore its own
+    keep-alive HTTP session - and retries failed batches with exponential backoff without holding up the parser.
+    Use it as a context manager so that every queued batch is flushed before the script exits.
+
+    Batches are regrouped into requests by size (see BatchSizer) rather than sent as the parsers made them - a worker
+    sends any batches already queued behind the one it picks up along with it, and splits ones that are too big. A
+    retry resends only the part of a batch that hasn't been written, split to the (by then smaller) target size.
+
+    Batches that still fail once retries run out are appended to a dead-letter file (in line protocol), so they
+    can be replayed later with replay_dead_letters.py. Batches finish out of order across threads, so on_durable is
+    only called with a batch's position once it, and every batch queued before it, has been dealt with. It's called
+    without holding the lock write() takes, so a slow checkpoint save doesn't hold up the parser.
+    """
+    def __init__(self, logger, client_factory, threads=4, queue_size=None, stop_max_attempt_number=5,
+                 wait_exponential_multiplier=1000, wait_exponential_max=120000, dead_letter_file=None,
+                 on_durable=None, sizer=None):
+        """
+        :param logger: logger to report progress and errors to
+        :param client_factory: callable returning a new sink, e.g. from sinks.sink_factory() - called once per worker thread
+        :param threads: number of concurrent writer threads
+        :param queue_size: maximum number of batches waiting to be written. Defaults to twice the thread count.
+        :param dead_letter_file: file to append batches that we gave up on to
+        :param on_durable: callable taking the position passed to write(), e.g. Checkpoint.save
+        :param sizer: BatchSizer deciding how much to send per request. Defaults to a BatchSizer().
+        """
+        self.logger = logger
+        self.client_factory = client_factory
+        self.threads = threads
+        self.stats = WriterStats()
+        self._queue = queue.Queue(maxsize=queue_size or threads * 2)
+        self._retrying = Retrying(stop_max_attempt_number=stop_max_attempt_number,
+                                  wait_exponential_multiplier=wait_exponential_multiplier,
+                                  wait_exponential_max=wait_exponential_max,
+                                  retry_on_exception=self._should_retry)
+        self._workers = []
+        self.dead_letter_file = dead_letter_file
+        self.on_durable = on_durable
+        self.sizer = sizer or BatchSizer()
+        # Guards the sequence numbers - held only briefly, as write() takes it too
+        self._lock = threading.Lock()
+        self._next_sequence = 0
+        self._durable_sequence = 0
+        self._finished = {}
+        # Held while on_durable runs (it may fsync), so that positions are reported in order without holding _lock
+        self._durable_lock = threading.Lock()
+        self._reported_sequence = 0
+        self._dead_letter_lock = threading.Lock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        for i in range(self.threads):
+            worker = threading.Thread(target=self._run, name="influxdb-writer-{}".format(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def write(self, points, line_number, position=None):
+        """
+        Queue a batch of points for writing. Blocks while the queue is full.
+        A batch is either a list of point dicts, or a list of line protocol lines (bytes) from a LineEncoder.
+        :param position: where the batch ends in the input, passed to on_durable once the batch is written
+        """
+        with self._lock:
+            sequence = self._next_sequence
+            self._next_sequence += 1
+        if points:
+            self._queue.put((sequence, points, line_number, position))
+        else:
+            self._finish(sequence, position)
+
+    def close(self):
+        """Wait for all queued batches to be written, then stop the worker threads."""
+        self._queue.join()
+        for _ in self._workers:
+            self._queue.put(_STOP)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self.logger.info("Finished writing - {}".format(self.stats.summary()))
+
+    def _should_retry(self, exception):
+        if isinstance(exception, (RequestException, InfluxDBClientError, InfluxDBServerError)):
+            self.logger.error("Unable to write to InfluxDB - {}".format(exception))
+            self.logger.info("Retrying...")
+            return True
+        return False
+
+    def _run(self):
+        client = self.client_factory()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    self._queue.task_done()
+                    return
+                items = [item]
+                try:
+                    self._take_queued(items)
+                    self._write_batches(client, items)
+                finally:
+                    for _ in items:
+                        self._queue.task_done()
+        finally:
+            client.close()
+
+    def _take_queued(self, items):
+        """Add batches waiting on the queue to items, while they'd fit in one request."""
+        size = self.sizer.size(items[0][1])
+        points = len(items[0][1])
+        while size is not None and size < self.sizer.target_bytes and points < self.sizer.max_points:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is _STOP:
+                # Another worker's - put it back for them
+                self._queue.task_done()
+                self._queue.put(item)
+                return
+            items.append(item)
+            batch_size = self.sizer.size(item[1])
+            size = size + batch_size if batch_size is not None else None
+            points += len(item[1])
+
+    def _finish(self, sequence, position):
+        """Record a batch as dealt with, and report the furthest position up to which every batch is."""
+        with self._lock:
+            self._finished[sequence] = position
+            durable = None
+            while self._durable_sequence in self._finished:
+                position = self._finished.pop(self._durable_sequence)
+                self._durable_sequence += 1
+                if position is not None:
+                    durable = position
+            reached = self._durable_sequence
+        if durable is not None and self.on_durable:
+            with self._durable_lock:
+                # Another thread may have got further while this one waited - don't go back to this position
+                if reached > self._reported_sequence:
+                    self._reported_sequence = reached
+                    self.on_durable(durable)
+
+    def _dead_letter(self, points, line_number):
+        if not self.dead_letter_file:
+            return
+        if not isinstance(points[0], bytes):
+            points = [line.encode('utf-8') for line in make_lines({'points': points}, precision='n').splitlines()]
+        with self._dead_letter_lock, open(self.dead_letter_file, 'ab') as f:
+            f.write("# Batch ending at line {}\n".format(line_number).encode('utf-8'))
+            f.write(b'\n'.join(points) + b'\n')
+        self.logger.error("Saved {} points to {} - replay them with replay_dead_letters.py".format(
+            len(points), self.dead_letter_file))
+
+    def _write_batches(self, client, items):
+        """Write (sequence, points, line_number, position) batches from the queue, in as few requests as fit."""
+        points = [point for sequence, batch, line_number, position in items for point in batch]
+        line_number = items[-1][2]
+        # How many of the points have been written, so retries carry on from there
+        written = [0]
+        attempts = [0]
+
+        def attempt():
+            attempts[0] += 1
+            if attempts[0] > 1:
+                self.stats.record_retry()
+            remaining = points[written[0]:]
+            for request in self.sizer.split(remaining, self.sizer.size(remaining)):
+                size = self.sizer.size(request)
+                started = time.time()
+                try:
+                    client.send(request)
+                except Exception:
+                    self.sizer.failed(size)
+                    raise
+                self.sizer.record(size, time.time() - started)
+                self.stats.request_sent()
+                written[0] += len(request)
+
+        for _ in items:
+            self.stats.batch_started()
+        try:
+            self._retrying.call(attempt)
+        except Exception as e:
+            self.logger.error("Retries exceeded. Giving up on batch ending at line {} - {}".format(line_number, e))
+            # Only what wasn't written - requests before the one that failed went through
+            batch_start = 0
+            for sequence, batch, batch_line_number, position in items:
+                self.stats.batch_finished(len(batch), failed=True)
+                unwritten = batch[max(0, written[0] - batch_start):]
+                if unwritten:
+                    self._dead_letter(unwritten, batch_line_number)
+                batch_start += len(batch)
+        else:
+            for sequence, batch, batch_line_number, position in items:
+                self.stats.batch_finished(len(batch))
+            self.logger.info("Wrote in {} points. Processed up to line {}. {}, requests of up to {}KB".format(
+                len(points), line_number, self.stats.summary(), self.sizer.target_bytes // 1024))
+        for sequence, batch, batch_line_number, position in items:
+            self._finish(sequence, position)